@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of import_HLS_pixel_data.py on a synthetic HLS archive
+(see make_synthetic_hls.py). Linux only: it reads /proc.
+
+Each extraction mode is run as a separate process in a work directory holding
+the synthetic archive, and the benchmark reports for each mode:
+    seconds       : wall time of the run (including Python start-up)
+    granules/s    : granules in the archive divided by seconds
+    files opened  : rasterio.open calls in the run and its worker processes
+    MB read       : bytes read by the run's processes (rchar in /proc/<pid>/io,
+                    sampled until each process exits)
+    peak RSS MB   : highest total resident memory of the run's processes
+
+Modes that must write the same files as the serial run (--io-threads,
+--workers) are checked byte for byte against it. It also times the block read planner of hls_block_reader.py on one band file
+with many random sites (--planner-sites), as it runs for every band file read.
+
+Example:
+    python benchmark_hls_import.py --granules 20 --modes serial qa-skip workers
+"""
+
+# Imports
+import argparse
+import hashlib
+import json
+import os
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Extraction modes: name -> (import script arguments, whether to run once
+# before measuring, so an --incremental run finds nothing new)
+modes = {'serial':([],False),
+         'qa-skip':(['--qa-skip'],False),
+         'io-threads':(['--io-threads','4'],False),
+         'workers':(['--workers','4'],False),
+         'array':(['--window-format','array'],False),
+         'stream':(['--stream','100'],False),
+         'incremental-noop':(['--incremental'],True)}
+
+# Modes whose output files must be identical to the serial mode's
+serial_equivalent_modes = ('io-threads','workers')
+
+# Tile and block size of the synthetic archive (see make_synthetic_hls.py),
+# for the planner check
+planner_tile_size = 3660
+planner_block_size = 256
+
+# Paths
+script_dir = os.path.dirname(os.path.abspath(__file__))
+import_script = os.path.join(script_dir, 'import_HLS_pixel_data.py')
+archive_root = 'path_to_hls_imagery' # image_path_1 of the import script, relative to the work directory
+output_dir = 'data/outputs_hls/'
+
+# Functions
+def run_child(open_log,script,script_args):
+    """
+    Runs a script as __main__, counting rasterio.open calls by appending a byte
+    to open_log for each one. Worker processes are forked from this process, so
+    they count their opens too.
+    """
+    import rasterio
+    log = os.open(open_log, os.O_WRONLY|os.O_APPEND|os.O_CREAT)
+    open_dataset = rasterio.open
+    def counting_open(*args,**kwargs):
+        os.write(log, b'.')
+        return open_dataset(*args,**kwargs)
+    rasterio.open = counting_open
+    sys.argv = [script]+script_args
+    sys.path.insert(0, os.path.dirname(script))
+    runpy.run_path(script, run_name='__main__')
+
+def return_process_tree(pid):
+    """
+    Returns the list of pid and its running descendants
+    """
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/'+entry+'/stat') as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            parents[int(entry)] = int(stat[stat.rindex(')')+2:].split()[1])
+    tree = [pid]
+    for p in tree:
+        tree.extend(child for child,parent in parents.items() if parent == p)
+    return tree
+
+def return_process_stats(pid):
+    """
+    Returns (bytes read, resident memory in bytes) of a process, or None if it has exited
+    """
+    try:
+        with open('/proc/'+str(pid)+'/io') as f:
+            rchar = int(next(line for line in f if line.startswith('rchar:')).split()[1])
+        with open('/proc/'+str(pid)+'/status') as f:
+            rss = next((int(line.split()[1])*1024 for line in f if line.startswith('VmRSS:')), 0)
+    except (OSError, StopIteration):
+        return None
+    return rchar,rss
+
+def run_mode(script_args,workdir,interval=0.02):
+    """
+    Parameters
+    ----------
+    script_args : list of arguments for the import script
+    workdir : directory holding the synthetic archive and the output directory
+    interval : seconds between samples of /proc
+
+    Returns
+    -------
+    metrics : dictionary of seconds, files_opened, bytes_read, peak_rss
+
+    """
+    open_log = os.path.join(workdir, 'opens.log')
+    if os.path.exists(open_log):
+        os.remove(open_log)
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', open_log, import_script]+script_args,
+                            cwd=workdir, stdout=subprocess.DEVNULL)
+    bytes_read = {}
+    peak_rss = 0
+    while True:
+        pid,status,rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        rss = 0
+        for p in return_process_tree(proc.pid):
+            stats = return_process_stats(p)
+            if stats is not None:
+                bytes_read[p] = stats[0]
+                rss += stats[1]
+        peak_rss = max(peak_rss, rss)
+        time.sleep(interval)
+    seconds = time.perf_counter()-start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise Exception("import_HLS_pixel_data.py "+' '.join(script_args)+" failed with exit code "+str(proc.returncode))
+    files_opened = os.path.getsize(open_log) if os.path.exists(open_log) else 0
+    return {'seconds':seconds,
+            'files_opened':files_opened,
+            'bytes_read':sum(bytes_read.values()),
+            'peak_rss':max(peak_rss, rusage.ru_maxrss*1024)}
+
+def return_output_digests(directory):
+    """
+    Returns a dictionary of file name -> SHA-256 digest of the files in a directory
+    """
+    digests = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name),'rb') as f:
+            digests[name] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+def time_block_planner(sites,seed=0):
+    """
+    Parameters
+    ----------
+    sites : number of random sites on one tile
+    seed : seed of the random site positions
+
+    Returns
+    -------
+    metrics : dictionary of sites, reads (number of reads planned) and seconds
+        taken by plan_block_reads for the sites' 4x3 pixel windows
+
+    """
+    import numpy as np
+    from hls_block_reader import plan_block_reads, return_block_box
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(2, planner_tile_size-2, size=sites)
+    cols = rng.integers(1, planner_tile_size-2, size=sites)
+    boxes = {str(i):return_block_box(int(row)-2,int(col)-1,4,3,planner_block_size,planner_block_size)
+             for i,(row,col) in enumerate(zip(rows,cols))}
+    start = time.perf_counter()
+    reads = plan_block_reads(boxes)
+    seconds = time.perf_counter()-start
+    if sorted(name for box,names in reads for name in names) != sorted(boxes):
+        raise Exception("plan_block_reads did not plan one read for every site")
+    return {'sites':sites, 'reads':len(reads), 'seconds':seconds}
+
+def run_benchmark(workdir,mode_names,phenocam_args,repeat=1):
+    """
+    Parameters
+    ----------
+    workdir : directory holding the synthetic archive
+    mode_names : list of keys of modes to run (serial runs first)
+    phenocam_args : phenocam arguments for the import script (e.g. ['--all'])
+    repeat : number of runs of each mode; the fastest is reported
+
+    Returns
+    -------
+    results : dictionary of mode name -> metrics (see run_mode) plus granules,
+        granules_per_second and, for serial_equivalent_modes run with the serial
+        mode, identical_to_serial (whether every output file has the same bytes)
+
+    """
+    import import_HLS_pixel_data as hls
+    hls.image_path_1 = os.path.join(workdir, archive_root)
+    granules = len(hls.return_granule_list(hls.return_tile_paths('L30', hls.years_L30)+hls.return_tile_paths('S30', hls.years_S30)))
+    results = {}
+    digests = {}
+    for name in sorted(mode_names, key=lambda name: name != 'serial'):
+        mode_args,prerun = modes[name]
+        runs = []
+        for r in range(repeat):
+            shutil.rmtree(os.path.join(workdir, output_dir), ignore_errors=True)
+            os.makedirs(os.path.join(workdir, output_dir))
+            if prerun:
+                run_mode(phenocam_args+mode_args, workdir)
+            runs.append(run_mode(phenocam_args+mode_args, workdir))
+        metrics = min(runs, key=lambda m: m['seconds'])
+        metrics['granules'] = granules
+        metrics['granules_per_second'] = granules/metrics['seconds']
+        digests[name] = return_output_digests(os.path.join(workdir, output_dir))
+        if name in serial_equivalent_modes and 'serial' in digests:
+            metrics['identical_to_serial'] = digests[name] == digests['serial']
+        results[name] = metrics
+        print(name.ljust(18)+format(metrics['seconds'],'8.2f')+format(metrics['granules_per_second'],'12.1f')+
+              format(metrics['files_opened'],'14d')+format(metrics['bytes_read']/1e6,'10.1f')+format(metrics['peak_rss']/1e6,'13.1f'))
+        if metrics.get('identical_to_serial') is False:
+            changed = sorted(f for f in set(digests[name])|set(digests['serial']) if digests[name].get(f) != digests['serial'].get(f))
+            print("  outputs differ from the serial run: "+', '.join(changed))
+    return results
+
+"""
+Generate the archive and run the benchmark
+"""
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3], sys.argv[4:])
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description="Benchmark import_HLS_pixel_data.py on a synthetic HLS archive")
+    parser.add_argument("--workdir",type=str,default=None,
+                        help="directory for the archive and outputs (default: a temporary directory, "
+                             "removed afterwards). An existing archive in it is reused")
+    parser.add_argument("--modes",type=str,nargs='+',choices=list(modes),default=list(modes))
+    parser.add_argument("--phenocams",type=str,nargs='+',default=None,
+                        help="phenocams to extract (default: --all)")
+    parser.add_argument("--granules",type=int,default=20,
+                        help="granules per satellite and year in the archive (default 20)")
+    parser.add_argument("--fill-fraction",type=float,default=0.1)
+    parser.add_argument("--cloud-fraction",type=float,default=0.2)
+    parser.add_argument("--repeat",type=int,default=1,
+                        help="runs per mode, reporting the fastest (default 1)")
+    parser.add_argument("--planner-sites",type=int,default=2000,
+                        help="random sites for the block planner timing (default 2000, 0 to skip)")
+    parser.add_argument("--json",type=str,default=None,
+                        help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix='hls_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        if not os.path.isdir(os.path.join(workdir, archive_root+'L30')):
+            from make_synthetic_hls import make_archive
+            n = make_archive(os.path.join(workdir, archive_root), args.granules,
+                             fill_fraction=args.fill_fraction, cloud_fraction=args.cloud_fraction)
+            print(str(n)+" synthetic granules written to "+workdir)
+        print('mode'.ljust(18)+'seconds'.rjust(8)+'granules/s'.rjust(12)+'files opened'.rjust(14)+'MB read'.rjust(10)+'peak RSS MB'.rjust(13))
+        results = run_benchmark(workdir, args.modes, args.phenocams or ['--all'], args.repeat)
+        if args.planner_sites > 0:
+            planner = time_block_planner(args.planner_sites)
+            results['block-planner'] = planner
+            print("block planner: "+str(planner['sites'])+" sites in "+str(planner['reads'])+" reads, "
+                  +format(planner['seconds'],'.3f')+" s per band file")
+        if args.json:
+            with open(args.json,'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
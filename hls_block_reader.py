@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Block-aligned window reads for import_HLS_pixel_data.py
+
+HLS band files are tiled GeoTIFFs: pixels are stored and compressed in
+internal blocks (e.g. 256x256). Reading a small window decompresses every
+block the window touches, so reading nearby sites one by one decompresses
+the same block again for each site. BlockReader instead plans the reads for
+all sites at once: site windows are mapped to the blocks they touch, sites
+whose blocks overlap are merged into one block-aligned read (as long as the
+merged read covers no blocks that neither needed), and decoded blocks are kept
+in a small LRU cache for the life of the open dataset. Each block is then
+decompressed once no matter how many sites fall inside it.
+"""
+
+# Imports
+from collections import OrderedDict
+import numpy as np
+
+# Maximum number of decoded blocks kept per open dataset
+# (64 blocks of 256x256 int16 pixels is 8 MB)
+block_cache_blocks = 64
+
+# Functions
+def return_block_box(row,col,height,width,block_height,block_width):
+    """
+    Parameters
+    ----------
+    row, col : top left pixel of the window
+    height, width : size of the window in pixels
+    block_height, block_width : size of the internal blocks
+
+    Returns
+    -------
+    box : (first block row, first block col, last block row, last block col)
+        of the blocks the window touches
+
+    """
+    return (row//block_height, col//block_width,
+            (row+height-1)//block_height, (col+width-1)//block_width)
+
+def return_box_blocks(box):
+    """
+    Returns the number of blocks in a (first row, first col, last row, last col) box
+    """
+    return (box[2]-box[0]+1)*(box[3]-box[1]+1)
+
+def return_box_keys(box):
+    """
+    Returns the list of (block row, block col) of the blocks in a block box
+    """
+    return [(r,c) for r in range(box[0],box[2]+1) for c in range(box[1],box[3]+1)]
+
+def plan_block_reads(boxes):
+    """
+    Parameters
+    ----------
+    boxes : dictionary of site name -> block box (see return_block_box)
+
+    Returns
+    -------
+    reads : list of (block box, list of site names), one per read, sorted by
+        box. Two reads are merged when their boxes overlap and the merged box
+        has no more blocks than the two boxes cover together, so merging never
+        reads a block that no site needs.
+
+    """
+    # Each read is only compared with the reads sharing one of its blocks
+    # (found through the readers of each block), and a merged read is checked
+    # again, so the plan ends when no two reads can be merged
+    reads = {}
+    readers = {}
+    for i,(name,box) in enumerate(sorted(boxes.items(), key=lambda item: item[1])):
+        reads[i] = (box,[name])
+        for key in return_box_keys(box):
+            readers.setdefault(key,set()).add(i)
+    pending = sorted(reads, reverse=True)
+    next_read = len(reads)
+    while pending:
+        i = pending.pop()
+        if i not in reads:
+            continue
+        a = reads[i][0]
+        for j in sorted(set().union(*(readers[key] for key in return_box_keys(a)))-{i}):
+            b = reads[j][0]
+            overlap = (max(a[0],b[0]), max(a[1],b[1]), min(a[2],b[2]), min(a[3],b[3]))
+            box = (min(a[0],b[0]), min(a[1],b[1]), max(a[2],b[2]), max(a[3],b[3]))
+            if return_box_blocks(box) <= return_box_blocks(a)+return_box_blocks(b)-return_box_blocks(overlap):
+                for k in (i,j):
+                    for key in return_box_keys(reads[k][0]):
+                        readers[key].discard(k)
+                reads[next_read] = (box, reads.pop(i)[1]+reads.pop(j)[1])
+                for key in return_box_keys(box):
+                    readers.setdefault(key,set()).add(next_read)
+                pending.append(next_read)
+                next_read += 1
+                break
+    return sorted(reads.values(), key=lambda read: read[0])
+
+class BlockReader:
+    """
+    Reads pixel windows from an open single-band dataset one whole internal
+    block at a time, keeping decoded blocks in an LRU cache
+
+    Parameters
+    ----------
+    src : open rasterio dataset
+    max_blocks : maximum number of decoded blocks to keep
+    count_bytes : whether to add up the size in the file of the blocks read
+        (in bytes_read; blocks_read is always counted)
+
+    """
+    def __init__(self,src,max_blocks=block_cache_blocks,count_bytes=False):
+        self.src = src
+        self.block_height,self.block_width = src.block_shapes[0]
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.count_bytes = count_bytes
+        self.blocks_read = 0
+        self.bytes_read = 0
+
+    def return_block_bytes(self,r,c):
+        """
+        Returns the size in the file of a block (compressed), 0 for a sparse block
+        """
+        from rasterio.errors import RasterBlockError
+        try:
+            return self.src.block_size(1,r,c)
+        except RasterBlockError:
+            return 0
+
+    def read_box(self,box):
+        """
+        Reads the blocks of a block box that are not cached, in one read, and caches them
+        """
+        from rasterio.windows import Window
+        missing = [(r,c) for r in range(box[0],box[2]+1) for c in range(box[1],box[3]+1) if (r,c) not in self.blocks]
+        if not missing:
+            return
+        box = (min(r for r,c in missing), min(c for r,c in missing), max(r for r,c in missing), max(c for r,c in missing))
+        row0 = box[0]*self.block_height; col0 = box[1]*self.block_width
+        row1 = min((box[2]+1)*self.block_height, self.src.height)
+        col1 = min((box[3]+1)*self.block_width, self.src.width)
+        data = self.src.read(1, window=Window(col0,row0,col1-col0,row1-row0))
+        for r in range(box[0],box[2]+1):
+            for c in range(box[1],box[3]+1):
+                self.blocks_read += 1
+                if self.count_bytes:
+                    self.bytes_read += self.return_block_bytes(r,c)
+                self.blocks[(r,c)] = data[r*self.block_height-row0:(r+1)*self.block_height-row0,
+                                          c*self.block_width-col0:(c+1)*self.block_width-col0]
+                self.blocks.move_to_end((r,c))
+
+    def window_from_blocks(self,row,col,height,width):
+        """
+        Copies a window out of the cached blocks it touches
+        """
+        w = np.empty((height,width), dtype=self.src.dtypes[0])
+        box = return_block_box(row,col,height,width,self.block_height,self.block_width)
+        for r in range(box[0],box[2]+1):
+            for c in range(box[1],box[3]+1):
+                block = self.blocks[(r,c)]
+                self.blocks.move_to_end((r,c))
+                top = max(row, r*self.block_height); bottom = min(row+height, (r+1)*self.block_height)
+                left = max(col, c*self.block_width); right = min(col+width, (c+1)*self.block_width)
+                w[top-row:bottom-row,left-col:right-col] = block[top-r*self.block_height:bottom-r*self.block_height,
+                                                                 left-c*self.block_width:right-c*self.block_width]
+        return w
+
+    def read_windows(self,windows):
+        """
+        Parameters
+        ----------
+        windows : dictionary of name -> (row, col, height, width) of windows
+            lying inside the dataset
+
+        Returns
+        -------
+        arrays : dictionary of name -> 2D array of the window's pixels (band 1)
+
+        """
+        boxes = {name:return_block_box(*window,self.block_height,self.block_width) for name,window in windows.items()}
+        arrays = {}
+        for box,names in plan_block_reads(boxes):
+            self.read_box(box)
+            for name in names:
+                arrays[name] = self.window_from_blocks(*windows[name])
+            # Evict only once the read's windows are copied out, so a read
+            # larger than the cache still works
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        return {name:arrays[name] for name in windows}
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite catalog of the granules in an HLS bulk download, for import_HLS_pixel_data.py --catalog
+
+The catalog lists every granule under <root>L30 and <root>S30 (root is
+image_path_1 of the import script) with its sensor, tile, year, DOY and
+version, parsed from the granule name, its directory modification time, and
+the latest modification time and total size of its band files (the
+signature the import script keeps in its manifests). Each band file is
+listed with its path, size and modification time.
+
+Building the catalog walks the whole archive once. A refresh lists the band
+files of every granule and compares their sizes and modification times with
+the catalog, and only rewrites the rows of granules that are new or changed
+(--quick only lists the granules whose directory changed, which misses band
+files rewritten in place). Queries by sensor, tile and date range then
+replace walking the filesystem. The catalog records the archive root and
+the time of its last refresh, and return_stale_reasons tells when the year
+or tile directories changed since.
+
+Run as a script to build or refresh a catalog:
+    python hls_catalog.py hls_catalog.sqlite path_to_hls_imagery
+"""
+
+# Imports
+import argparse
+import os
+import sqlite3
+import time
+
+schema = """
+CREATE TABLE IF NOT EXISTS granules (granule TEXT PRIMARY KEY,
+                                     satellite TEXT,
+                                     tile TEXT,
+                                     year INTEGER,
+                                     doy INTEGER,
+                                     version TEXT,
+                                     path TEXT,
+                                     dir_mtime INTEGER,
+                                     mtime INTEGER,
+                                     size INTEGER);
+CREATE TABLE IF NOT EXISTS bands (granule TEXT,
+                                  band TEXT,
+                                  path TEXT,
+                                  size INTEGER,
+                                  mtime INTEGER,
+                                  PRIMARY KEY (granule, band));
+CREATE INDEX IF NOT EXISTS granules_by_date ON granules (satellite, tile, year, doy);
+CREATE TABLE IF NOT EXISTS catalog (key TEXT PRIMARY KEY,
+                                    value TEXT);
+"""
+
+# Functions
+def parse_granule_name(name):
+    """
+    Parameters
+    ----------
+    name : string containing an HLS granule name, e.g. 'HLS.L30.T13SCS.2021010T173000.v2.0'
+
+    Returns
+    -------
+    granule : dictionary of satellite, tile, year, doy and version (e.g. 'v2.0')
+
+    """
+    parts = name.split('.')
+    if len(parts) < 5 or parts[0] != 'HLS' or len(parts[3]) < 7 or not parts[3][:7].isdigit():
+        raise Exception("Not an HLS granule name: "+name)
+    return {'satellite':parts[1],
+            'tile':parts[2],
+            'year':int(parts[3][:4]),
+            'doy':int(parts[3][4:7]),
+            'version':'.'.join(parts[4:])}
+
+def open_catalog(filename):
+    """
+    Opens (creating if needed) a catalog database and returns the connection
+    """
+    db = sqlite3.connect(filename)
+    db.executescript(schema)
+    return db
+
+def return_tile_dirs(year_path,depth=4):
+    """
+    Parameters
+    ----------
+    year_path : string containing the path to one year of L30 or S30 imagery
+    depth : number of directory levels naming a tile (zone/latitude band/square/square)
+
+    Returns
+    -------
+    tile_dirs : sorted list of tile directories relative to year_path, in the
+        form of image_path_2 of import_HLS_pixel_data.py (e.g. '/13/S/C/S')
+
+    """
+    tile_dirs = ['']
+    for level in range(depth):
+        tile_dirs = [tile_dir+'/'+entry.name for tile_dir in tile_dirs
+                     for entry in sorted(os.scandir(year_path+tile_dir), key=lambda entry: entry.name) if entry.is_dir()]
+    return tile_dirs
+
+def return_archive_dirs(root,depth=5):
+    """
+    Returns the sorted list of directories depth levels below <root><satellite>,
+    e.g. the tile directories (<root><satellite>/<year>/<zone>/<band>/<square>/<square>)
+    for depth 5 and the year directories for depth 1
+    """
+    return [root+satellite+tile_dir for satellite in ('L30','S30') if os.path.isdir(root+satellite)
+            for tile_dir in return_tile_dirs(root+satellite, depth)]
+
+def return_stale_reasons(db,root):
+    """
+    Parameters
+    ----------
+    db : open catalog
+    root : string the satellite folders are appended to
+
+    Returns
+    -------
+    reasons : list of reasons the catalog may not match the archive, empty if
+        none: it was refreshed from another root, or a year or tile directory
+        changed (granules or tiles added or removed) since its last refresh.
+        Band files rewritten in place leave these directories unchanged, so
+        only a refresh finds them.
+
+    """
+    values = dict(db.execute("SELECT key, value FROM catalog"))
+    if 'root' not in values:
+        return ["it does not record the archive it was built from"]
+    if values['root'] != os.path.abspath(root):
+        return ["it was built from "+values['root']+", not "+os.path.abspath(root)]
+    changed = [d for d in return_archive_dirs(root, 1)+return_archive_dirs(root)
+               if os.stat(d).st_mtime_ns > int(values['refreshed'])]
+    if changed:
+        return [str(len(changed))+" year or tile directories changed since its last refresh (e.g. "+changed[0]+")"]
+    return []
+
+def scan_granule(granule_dir):
+    """
+    Returns (bands, mtime, size): rows of (band, path, size, mtime) for the band
+    files of a granule, and their latest modification time and total size
+    """
+    bands = []
+    with os.scandir(granule_dir) as entries:
+        for entry in entries:
+            st = entry.stat()
+            band = entry.name[len(os.path.basename(granule_dir))+1:].rsplit('.',1)[0]
+            bands.append((band, entry.path, st.st_size, st.st_mtime_ns))
+    return bands, max((b[3] for b in bands), default=0), sum(b[2] for b in bands)
+
+def refresh_catalog(db,root,quick=False):
+    """
+    Parameters
+    ----------
+    db : open catalog (see open_catalog)
+    root : string the satellite folders are appended to (image_path_1 of the import script)
+    quick : whether to skip granules whose directory modification time is
+        unchanged without listing their band files. Faster, but misses band
+        files rewritten in place, which leave the directory unchanged.
+
+    Returns
+    -------
+    added, updated, removed : numbers of granules added, changed and removed
+
+    """
+    refreshed = time.time_ns()
+    known = {granule:dir_mtime for granule,dir_mtime in db.execute("SELECT granule, dir_mtime FROM granules")}
+    known_bands = {}
+    if not quick:
+        for granule,band,path,size,mtime in db.execute("SELECT granule, band, path, size, mtime FROM bands"):
+            known_bands.setdefault(granule,set()).add((band,path,size,mtime))
+    found = set()
+    added = 0; updated = 0
+    for tile_dir in return_archive_dirs(root):
+        with os.scandir(tile_dir) as entries:
+            granule_dirs = [entry for entry in entries if entry.is_dir()]
+        for entry in granule_dirs:
+            try:
+                granule = parse_granule_name(entry.name)
+            except Exception:
+                continue
+            found.add(entry.name)
+            dir_mtime = entry.stat().st_mtime_ns
+            if quick and known.get(entry.name) == dir_mtime:
+                continue
+            bands,mtime,size = scan_granule(entry.path)
+            if known.get(entry.name) == dir_mtime and known_bands.get(entry.name, set()) == set(bands):
+                continue
+            db.execute("DELETE FROM bands WHERE granule = ?", (entry.name,))
+            db.executemany("INSERT INTO bands VALUES (?,?,?,?,?)", [(entry.name,)+band for band in bands])
+            db.execute("INSERT OR REPLACE INTO granules VALUES (?,?,?,?,?,?,?,?,?,?)",
+                       (entry.name, granule['satellite'], granule['tile'], granule['year'], granule['doy'],
+                        granule['version'], entry.path+'/'+entry.name, dir_mtime, mtime, size))
+            if entry.name in known:
+                updated += 1
+            else:
+                added += 1
+    removed = [(granule,) for granule in known if granule not in found]
+    db.executemany("DELETE FROM granules WHERE granule = ?", removed)
+    db.executemany("DELETE FROM bands WHERE granule = ?", removed)
+    db.executemany("INSERT OR REPLACE INTO catalog VALUES (?,?)",
+                   (('root',os.path.abspath(root)),('refreshed',str(refreshed))))
+    db.commit()
+    return added,updated,len(removed)
+
+def query_granules(db,satellites=None,tiles=None,start=None,end=None):
+    """
+    Parameters
+    ----------
+    db : open catalog
+    satellites : optional list of sensors ('L30', 'S30') to keep
+    tiles : optional list of tiles (e.g. 'T13SCS') to keep
+    start, end : optional (year, doy) of the first and last dates to keep
+
+    Returns
+    -------
+    granules : list of (satellite, year, doy, tile, granule path without band
+        suffix, mtime, size), sorted by satellite, year, DOY and path
+
+    """
+    query = "SELECT satellite, year, doy, tile, path, mtime, size FROM granules WHERE 1"
+    values = []
+    if satellites:
+        query += " AND satellite IN ("+','.join('?'*len(satellites))+")"
+        values += list(satellites)
+    if tiles:
+        query += " AND tile IN ("+','.join('?'*len(tiles))+")"
+        values += list(tiles)
+    if start:
+        query += " AND (year > ? OR (year = ? AND doy >= ?))"
+        values += [start[0], start[0], start[1]]
+    if end:
+        query += " AND (year < ? OR (year = ? AND doy <= ?))"
+        values += [end[0], end[0], end[1]]
+    granules = db.execute(query, values).fetchall()
+    granules.sort(key=lambda g: (g[0],g[1],g[2],g[4]))
+    return granules
+
+"""
+Build or refresh the catalog given on the command line
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or refresh an HLS granule catalog")
+    parser.add_argument("catalog",type=str,help="SQLite file of the catalog (created if missing)")
+    parser.add_argument("root",type=str,nargs='?',default='path_to_hls_imagery',
+                        help="prefix of the L30/S30 folders, as image_path_1 in import_HLS_pixel_data.py")
+    parser.add_argument("--quick",action='store_true',
+                        help="only list the band files of granules whose directory changed "
+                             "(misses band files rewritten in place)")
+    args = parser.parse_args()
+    db = open_catalog(args.catalog)
+    added,updated,removed = refresh_catalog(db, args.root, args.quick)
+    n = db.execute("SELECT COUNT(*) FROM granules").fetchone()[0]
+    print(args.catalog+": "+str(n)+" granules ("+str(added)+" added, "+str(updated)+" changed, "+str(removed)+" removed)")
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Temporal cubes of HLS bands for extracting site time series in one read per band
+
+`build` reads every granule of each tile holding a site once, and stacks the
+pixels of the chunks around the sites into one cube per tile and band:
+    <cube_dir>/<tile>/<band>.npy : array of shape (chunks, dates, chunk size, chunk size),
+                                   int16 with -9999 fill (also for bands the
+                                   sensor lacks), or uint8 with 255 fill for Quality
+    <cube_dir>/<tile>/index.csv  : one row per date (granule) with Granule,
+                                   Satellite, Year, DOY, Mtime and Size, in the
+                                   order import_HLS_pixel_data.py reads them
+    <cube_dir>/<tile>/cube.json  : tile grid (crs, transform, width, height),
+                                   chunk size and the (row, col) of each chunk
+Chunks are squares of chunk size pixels on a grid starting at the tile's top
+left corner. A cube holds the chunks touched by the sites' windows plus
+--margin chunks around them, or every chunk of the tile with --full-tile.
+
+`extract` reads a site's window for all dates as one strided slice of each
+band cube (a chunk's dates are stored together), and writes the same outputs
+as import_HLS_pixel_data.py. Any site inside the cube's chunks can be
+extracted, or its statistics recomputed, without reading the archive.
+
+Examples:
+    python hls_cube.py build data/hls_cubes --all --root path_to_hls_imagery
+    python hls_cube.py extract data/hls_cubes jershrubland ibp
+"""
+
+# Imports
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+import import_HLS_pixel_data as hls
+from hls_sites import read_site_registry, SiteIndex
+from hls_window_store import window_bands, nodata
+
+# Fill value and type of each band cube
+cube_dtypes = {band:(np.uint8 if band == 'Quality' else np.int16) for band in window_bands}
+fill_values = {band:(255 if band == 'Quality' else nodata) for band in window_bands}
+
+# GDAL environment of this process, entered once by the first init_cube_worker
+worker_env = None
+
+# Functions
+def return_sites(args,parser):
+    """
+    Returns (phenocams, site_index): the site names selected on the command
+    line, and a SiteIndex if they come from a --sites registry (None for the
+    built-in phenocam pixel table)
+    """
+    site_index = SiteIndex(read_site_registry(args.sites)) if args.sites else None
+    site_names = list(site_index.registry['name']) if site_index else list(hls.phenocam_rows_cols)
+    if args.all:
+        return site_names,site_index
+    if not args.phen_name:
+        parser.error("give at least one phenocam name, or --all")
+    phenocams = list(dict.fromkeys(args.phen_name))
+    unknown = [phenocam for phenocam in phenocams if phenocam not in site_names]
+    if unknown:
+        parser.error("unknown site(s): "+', '.join(unknown))
+    return phenocams,site_index
+
+def return_tile_rows_cols(tile,grid,phenocams,site_index):
+    """
+    Returns dictionary of phenocam name -> (row, col) of the phenocams in a tile
+    """
+    if site_index is not None:
+        rows_cols = site_index.sites_in_grid(*grid)
+        return {phenocam:rows_cols[phenocam] for phenocam in phenocams if phenocam in rows_cols}
+    if tile == hls.phenocam_tile:
+        return {phenocam:hls.return_phenocam_row_col(phenocam) for phenocam in phenocams}
+    return {}
+
+def return_cube_chunks(rows_cols,chunk_size,margin,width,height):
+    """
+    Parameters
+    ----------
+    rows_cols : dictionary of site name -> (row, col)
+    chunk_size : size of a chunk in pixels
+    margin : number of chunks to add around each site's chunks
+    width, height : size of the tile in pixels
+
+    Returns
+    -------
+    chunks : sorted list of (chunk row, chunk col) touched by the sites' 3x4
+        windows, plus margin chunks around them
+
+    """
+    n_rows = -(-height//chunk_size); n_cols = -(-width//chunk_size)
+    chunks = set()
+    for row,col in rows_cols.values():
+        for chunk_row in range((row-2)//chunk_size-margin, (row+1)//chunk_size+margin+1):
+            for chunk_col in range((col-1)//chunk_size-margin, (col+1)//chunk_size+margin+1):
+                if 0 <= chunk_row < n_rows and 0 <= chunk_col < n_cols:
+                    chunks.add((chunk_row,chunk_col))
+    return sorted(chunks)
+
+def init_cube_worker(chunks,chunk_size):
+    """
+    Sets up a process for read_granule_chunks (see init_worker in
+    import_HLS_pixel_data.py); the GDAL environment is only entered on the
+    first call in a process, as build calls this again for every tile
+    """
+    global worker_chunks, worker_chunk_size, worker_env
+    worker_chunks = chunks
+    worker_chunk_size = chunk_size
+    if worker_env is None:
+        worker_env = rasterio.Env(**hls.gdal_options)
+        worker_env.__enter__()
+
+def read_granule_chunks(granule):
+    """
+    Parameters
+    ----------
+    granule : (satellite, year, doy, granule path) tuple from return_granule_list
+
+    Returns
+    -------
+    data : dictionary of band name -> array of shape (chunks, chunk size,
+        chunk size) of the granule's pixels in the cube chunks (fill outside
+        the tile), or None for bands the sensor does not have
+
+    """
+    satellite,year,doy,temp_path = granule
+    data = dict.fromkeys(window_bands)
+    for band,suffix in hls.bands_by_satellite[satellite].items():
+        chunk_data = np.full((len(worker_chunks),worker_chunk_size,worker_chunk_size), fill_values[band], dtype=cube_dtypes[band])
+        with rasterio.open(temp_path+'.'+suffix+'.tif',driver='GTiff') as src:
+            for k,(chunk_row,chunk_col) in enumerate(worker_chunks):
+                row0 = chunk_row*worker_chunk_size; col0 = chunk_col*worker_chunk_size
+                height = min(worker_chunk_size, src.height-row0); width = min(worker_chunk_size, src.width-col0)
+                chunk_data[k,:height,:width] = src.read(1, window=Window(col0,row0,width,height))
+        data[band] = chunk_data
+    return data
+
+def build_tile_cube(tile_dir,granules,signatures,grid,chunks,chunk_size,workers=1):
+    """
+    Parameters
+    ----------
+    tile_dir : string containing the directory of the tile's cube (replaced if it exists)
+    granules : list of (satellite, year, doy, granule path) of the tile, in output order
+    signatures : list of (mtime, size) of each granule (see return_granule_signature)
+    grid : (crs, transform, width, height) of the tile
+    chunks : list of (chunk row, chunk col) to store
+    chunk_size : size of a chunk in pixels
+    workers : number of processes reading granules
+
+    """
+    build_dir = tile_dir+'.tmp'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    cubes = {band:np.lib.format.open_memmap(build_dir+'/'+band+'.npy', mode='w+', dtype=cube_dtypes[band],
+                                            shape=(len(chunks),len(granules),chunk_size,chunk_size))
+             for band in window_bands}
+    if workers == 1:
+        init_cube_worker(chunks, chunk_size)
+        granule_chunks = map(read_granule_chunks, granules)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_cube_worker, initargs=(chunks,chunk_size))
+        granule_chunks = pool.map(read_granule_chunks, granules, chunksize=max(1, len(granules)//(workers*8)))
+    for t,data in enumerate(granule_chunks):
+        for band in window_bands:
+            cubes[band][:,t] = fill_values[band] if data[band] is None else data[band]
+    if workers > 1:
+        pool.shutdown()
+    for cube in cubes.values():
+        cube.flush()
+    del cubes
+    pd.DataFrame({'Granule':np.array([os.path.basename(g[3]) for g in granules], dtype=object),
+                  'Satellite':np.array([g[0] for g in granules], dtype=object),
+                  'Year':np.array([g[1] for g in granules], dtype=np.int64),
+                  'DOY':np.array([g[2] for g in granules], dtype=np.int64),
+                  'Mtime':np.array([sig[0] for sig in signatures], dtype=np.int64),
+                  'Size':np.array([sig[1] for sig in signatures], dtype=np.int64)}).to_csv(build_dir+'/index.csv', index=False)
+    crs,transform,width,height = grid
+    with open(build_dir+'/cube.json','w') as f:
+        json.dump({'crs':crs.to_string(), 'transform':list(transform)[:6], 'width':width, 'height':height,
+                   'chunk_size':chunk_size, 'chunks':[list(chunk) for chunk in chunks]}, f)
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    os.replace(build_dir, tile_dir)
+
+def read_cube(tile_dir,mmap=True):
+    """
+    Parameters
+    ----------
+    tile_dir : string containing the directory of a tile's cube
+    mmap : whether to memory map the band cubes (read-only) instead of loading them
+
+    Returns
+    -------
+    cubes : dictionary of band name -> cube array
+    index : data frame of the cube's dates (see build_tile_cube)
+    meta : dictionary of the tile grid (crs, transform as an Affine, width,
+        height), chunk_size and chunks (dictionary of (chunk row, chunk col) -> chunk index)
+
+    """
+    with open(tile_dir+'/cube.json') as f:
+        meta = json.load(f)
+    meta['crs'] = rasterio.crs.CRS.from_user_input(meta['crs'])
+    meta['transform'] = rasterio.Affine(*meta['transform'])
+    meta['chunks'] = {tuple(chunk):k for k,chunk in enumerate(meta['chunks'])}
+    index = pd.read_csv(tile_dir+'/index.csv', keep_default_na=False)
+    cubes = {band:np.load(tile_dir+'/'+band+'.npy', mmap_mode='r' if mmap else None) for band in window_bands}
+    return cubes,index,meta
+
+def read_cube_window(cube,chunks,chunk_size,row,col):
+    """
+    Parameters
+    ----------
+    cube : band cube of shape (chunks, dates, chunk size, chunk size)
+    chunks : dictionary of (chunk row, chunk col) -> chunk index
+    chunk_size : size of a chunk in pixels
+    row, col : row and col of the site
+
+    Returns
+    -------
+    w : array of shape (dates, 4, 3) of the site's window (rows row-2 to
+        row+1, cols col-1 to col+1) on every date; one strided slice per chunk
+        the window touches (usually one)
+
+    """
+    w = np.empty((cube.shape[1],4,3), dtype=cube.dtype)
+    top = row-2; left = col-1
+    for chunk_row in range(top//chunk_size, (top+3)//chunk_size+1):
+        for chunk_col in range(left//chunk_size, (left+2)//chunk_size+1):
+            if (chunk_row,chunk_col) not in chunks:
+                raise Exception("Pixel ("+str(row)+", "+str(col)+") is outside the cube; rebuild the cube with this site")
+            r0 = max(top, chunk_row*chunk_size); r1 = min(top+4, (chunk_row+1)*chunk_size)
+            c0 = max(left, chunk_col*chunk_size); c1 = min(left+3, (chunk_col+1)*chunk_size)
+            w[:,r0-top:r1-top,c0-left:c1-left] = cube[chunks[(chunk_row,chunk_col)],:,
+                                                      r0-chunk_row*chunk_size:r1-chunk_row*chunk_size,
+                                                      c0-chunk_col*chunk_size:c1-chunk_col*chunk_size]
+    return w
+
+def return_cube_window_rows(tile,cubes,index,meta,rows_cols):
+    """
+    Parameters
+    ----------
+    tile : string of the cube's tile, e.g. 'T13SCS'
+    cubes, index, meta : cube as returned by read_cube
+    rows_cols : dictionary of site name -> (row, col) in the tile
+
+    Returns
+    -------
+    window_rows : dictionary of site name -> ResultBuilder of window rows, as
+        import_HLS_pixel_data.py builds them from the granules
+
+    """
+    window_rows = {}
+    for name,(row,col) in rows_cols.items():
+        windows = {band:read_cube_window(cubes[band], meta['chunks'], meta['chunk_size'], row, col) for band in window_bands}
+        builder = hls.ResultBuilder(hls.window_columns, len(index), hls.window_dtypes)
+        for t,(satellite,year,doy) in enumerate(zip(index['Satellite'],index['Year'],index['DOY'])):
+            temp_data = {'Year':year,
+                         'DOY':doy,
+                         'Satellite':satellite,
+                         'Phenocam':name,
+                         'Tile':tile,
+                         'SkipReason':''}
+            temp_data.update({band:hls.return_window_pixels(np.array(windows[band][t])) for band in window_bands})
+            builder.add_row(temp_data)
+        window_rows[name] = builder
+    return window_rows
+
+"""
+Build cubes or extract sites from them
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build temporal HLS band cubes, or extract sites from them")
+    parser.add_argument("command",choices=('build','extract'))
+    parser.add_argument("cube_dir",type=str,help="directory of the cubes, one subdirectory per tile")
+    parser.add_argument("phen_name",type=str,nargs='*',help="name(s) of the phenocam(s)")
+    parser.add_argument("--all",action='store_true',help="every phenocam (or every site in --sites)")
+    parser.add_argument("--sites",type=str,default=None,
+                        help="CSV site registry (see hls_sites.py) instead of the built-in phenocam pixel table")
+    parser.add_argument("--chunk-size",type=int,default=64,help="build: chunk size in pixels (default 64)")
+    parser.add_argument("--margin",type=int,default=1,
+                        help="build: chunks to add around each site's chunks, so nearby sites can be "
+                             "added later without rebuilding (default 1)")
+    parser.add_argument("--full-tile",action='store_true',
+                        help="build: store every chunk of the tile (large: a 3660x3660 tile is 27 MB per band and date)")
+    parser.add_argument("--workers",type=int,default=1,help="build: number of processes reading granules")
+    parser.add_argument("--root",type=str,default=hls.image_path_1,
+                        help="build: prefix of the L30/S30 folders of the archive (default image_path_1 "
+                             "of import_HLS_pixel_data.py, "+hls.image_path_1+")")
+    parser.add_argument("--window-format",choices=('pickle','array'),default='pickle',
+                        help="extract: how to store the windows (see import_HLS_pixel_data.py)")
+    parser.add_argument("--parquet",action='store_true',help="extract: also write the Parquet analysis files")
+    args = parser.parse_intermixed_args()
+    phenocams,site_index = return_sites(args, parser)
+
+    if args.command == 'build':
+        if args.chunk_size < 4 or args.margin < 0 or args.workers < 1:
+            parser.error("--chunk-size must be at least 4, --margin at least 0 and --workers at least 1")
+        tile_paths = hls.return_tile_paths('L30', hls.years_L30, args.root) + hls.return_tile_paths('S30', hls.years_S30, args.root)
+        for tile in sorted({tp[2] for tp in tile_paths}):
+            temp_path = next((g for g in (hls.return_first_granule(tp[3]) for tp in tile_paths if tp[2] == tile) if g), None)
+            if temp_path is None:
+                continue
+            grid = hls.return_tile_grid(temp_path)
+            rows_cols = return_tile_rows_cols(tile, grid, phenocams, site_index)
+            if not rows_cols:
+                continue
+            crs,transform,width,height = grid
+            if args.full_tile:
+                chunks = [(r,c) for r in range(-(-height//args.chunk_size)) for c in range(-(-width//args.chunk_size))]
+            else:
+                chunks = return_cube_chunks(rows_cols, args.chunk_size, args.margin, width, height)
+            granules = hls.return_granule_list([tp for tp in tile_paths if tp[2] == tile])
+            signatures = [hls.return_granule_signature(g[3]) for g in granules]
+            build_tile_cube(os.path.join(args.cube_dir, tile), granules, signatures, grid, chunks, args.chunk_size, args.workers)
+            print(tile+": "+str(len(granules))+" dates x "+str(len(chunks))+" chunks for "+', '.join(rows_cols))
+    else:
+        tiles = sorted(d for d in os.listdir(args.cube_dir) if os.path.exists(os.path.join(args.cube_dir, d, 'cube.json')))
+        window_frames = {phenocam:[] for phenocam in phenocams}
+        manifests = {phenocam:[] for phenocam in phenocams}
+        site_margins = {phenocam:{} for phenocam in phenocams}
+        for tile in tiles:
+            cubes,index,meta = read_cube(os.path.join(args.cube_dir, tile))
+            grid = (meta['crs'], meta['transform'], meta['width'], meta['height'])
+            rows_cols = return_tile_rows_cols(tile, grid, phenocams, site_index)
+            for name,builder in return_cube_window_rows(tile, cubes, index, meta, rows_cols).items():
+                window_frames[name].append(builder.to_frame())
+                manifests[name].append(index[['Granule']].assign(Tile=tile).join(index.drop(columns='Granule'))
+                                      .assign(QAPolicy=hls.return_qa_label(None)))
+                site_margins[name][tile] = hls.return_tile_margin(*rows_cols[name], meta['width'], meta['height'])
+        for phenocam in phenocams:
+            if not window_frames[phenocam]:
+                print("No cube covers: "+phenocam)
+                continue
+            keys = ['Satellite','Year','DOY']
+            df_window = pd.concat(window_frames[phenocam], ignore_index=True).sort_values(keys, kind='mergesort', ignore_index=True)
+            if len(site_margins[phenocam]) > 1:
+                ranked = sorted(site_margins[phenocam], key=lambda tile: (-site_margins[phenocam][tile], tile))
+                df_window = hls.drop_overlap_duplicates(df_window, {tile:rank for rank,tile in enumerate(ranked)})
+            manifest = pd.concat(manifests[phenocam], ignore_index=True).sort_values(keys+['Tile'], kind='mergesort', ignore_index=True)
+            df_center,df_north = hls.return_center_north_frames(df_window)
+            hls.save_results(phenocam, df_window, df_center, df_north, manifest, args.window_format, args.parquet)
+            print(phenocam+" complete!")
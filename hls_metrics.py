@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Run metrics for import_HLS_pixel_data.py (--profile, --metrics-out, --progress)
+
+A Metrics object adds up the wall time and number of calls of each stage of
+a run (listing directories, opening band files, reading windows, computing
+statistics, writing outputs, ...) and counters such as granules read, files
+opened and bytes read. Worker processes and I/O threads record into their own
+Metrics object and hand the totals to the main process with each granule
+(see Metrics.pop), which merges them. With profiling off, the objects are
+None and timed() returns a shared do-nothing context, so the hooks cost one
+function call each.
+"""
+
+# Imports
+from collections import defaultdict
+from contextlib import nullcontext
+import json
+import threading
+import time
+
+no_timer = nullcontext()
+
+# Functions
+def timed(metrics,stage):
+    """
+    Returns a context timing the enclosed code as one call of stage, or a
+    do-nothing context if metrics is None
+    """
+    if metrics is None:
+        return no_timer
+    return StageTimer(metrics,stage)
+
+def format_seconds(seconds):
+    """
+    Returns seconds as h:mm:ss
+    """
+    seconds = int(round(seconds))
+    return str(seconds//3600)+':'+str(seconds//60 % 60).zfill(2)+':'+str(seconds % 60).zfill(2)
+
+class StageTimer:
+    """
+    Context adding the wall time of the enclosed code to a stage of a Metrics object
+    """
+    def __init__(self,metrics,stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self,*exc):
+        self.metrics.add_time(self.stage, time.perf_counter()-self.start)
+
+class Metrics:
+    """
+    Wall time and calls per stage, and named counters. Safe to share between threads.
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add_time(self,stage,seconds,calls=1):
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    def count(self,counter,n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def pop(self):
+        """
+        Returns the totals so far as a picklable (seconds, calls, counters) tuple
+        and resets them, so they can be sent to the main process and merged once
+        """
+        with self.lock:
+            totals = (dict(self.seconds), dict(self.calls), dict(self.counters))
+            self.seconds.clear(); self.calls.clear(); self.counters.clear()
+        return totals
+
+    def merge(self,totals):
+        """
+        Adds totals from pop (e.g. from a worker process)
+        """
+        seconds,calls,counters = totals
+        with self.lock:
+            for stage in seconds:
+                self.seconds[stage] += seconds[stage]
+                self.calls[stage] += calls[stage]
+            for counter in counters:
+                self.counters[counter] += counters[counter]
+
+    def report(self,wall_seconds,extra=None):
+        """
+        Parameters
+        ----------
+        wall_seconds : wall time of the whole run
+        extra : optional dictionary of other items for the report (e.g. arguments)
+
+        Returns
+        -------
+        report : dictionary of wall_seconds, stages (stage -> seconds and calls,
+            slowest first) and counters
+
+        """
+        report = {'wall_seconds':wall_seconds,
+                  'stages':{stage:{'seconds':self.seconds[stage], 'calls':self.calls[stage]}
+                            for stage in sorted(self.seconds, key=self.seconds.get, reverse=True)},
+                  'counters':dict(sorted(self.counters.items()))}
+        if extra:
+            report.update(extra)
+        return report
+
+    def write_json(self,filename,wall_seconds,extra=None):
+        """
+        Writes the report (see report) to a JSON file
+        """
+        with open(filename,'w') as f:
+            json.dump(self.report(wall_seconds,extra), f, indent=2)
+
+    def print_summary(self,wall_seconds):
+        """
+        Prints the stage times and counters
+        """
+        print('stage'.ljust(16)+'seconds'.rjust(10)+'calls'.rjust(10))
+        for stage,totals in self.report(wall_seconds)['stages'].items():
+            print(stage.ljust(16)+format(totals['seconds'],'10.3f')+format(totals['calls'],'10d'))
+        print('wall'.ljust(16)+format(wall_seconds,'10.3f'))
+        for counter,n in sorted(self.counters.items()):
+            print(counter+': '+str(n))
+
+class Progress:
+    """
+    Prints a progress line with throughput and ETA at most every interval seconds
+
+    Parameters
+    ----------
+    total : number of granules in the run
+    interval : seconds between progress lines
+
+    """
+    def __init__(self,total,interval):
+        self.total = total
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def update(self,done):
+        now = time.perf_counter()
+        if now-self.last < self.interval and done < self.total:
+            return
+        self.last = now
+        rate = done/(now-self.start) if now > self.start else 0.0
+        eta = format_seconds((self.total-done)/rate) if rate > 0 else '?'
+        print(str(done)+" of "+str(self.total)+" granules, "+format(rate,'.1f')+" granules/s, ETA "+eta, flush=True)
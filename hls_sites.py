@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Site registry for import_HLS_pixel_data.py
+
+Sites are read from a CSV file with a 'name' column and either
+    lat, lon : WGS84 coordinates, or
+    x, y, crs : projected coordinates and their CRS (e.g. EPSG:32613)
+Each row may use either form. For a given HLS tile, sites are projected to
+the tile's CRS (once per CRS), the ones inside the tile are found with a
+sorted-coordinate index, and converted to pixel row/col with the tile's
+affine transform.
+"""
+
+# Imports
+import numpy as np
+
+# Margin (in pixels) a site needs from the tile edge for its 3x4 window
+# (rows row-2 to row+1, cols col-1 to col+1)
+window_margin = {'top':2, 'bottom':1, 'left':1, 'right':1}
+
+# Functions
+def read_site_registry(filename):
+    """
+    Parameters
+    ----------
+    filename : string containing the path to the site registry CSV
+
+    Returns
+    -------
+    registry : data frame with columns name, x, y, crs (lat/lon rows have
+        x=lon, y=lat and crs EPSG:4326)
+
+    """
+    import pandas as pd
+    sites = pd.read_csv(filename)
+    if 'name' not in sites.columns:
+        raise Exception("Site registry needs a 'name' column")
+    if sites['name'].duplicated().any():
+        raise Exception("Site registry has duplicate names: "+', '.join(sites['name'][sites['name'].duplicated()].astype(str)))
+    x = pd.Series(np.nan, index=sites.index); y = pd.Series(np.nan, index=sites.index)
+    crs = pd.Series(None, index=sites.index, dtype=object)
+    if 'lat' in sites.columns and 'lon' in sites.columns:
+        geographic = sites['lat'].notna() & sites['lon'].notna()
+        x[geographic] = sites['lon'][geographic]; y[geographic] = sites['lat'][geographic]
+        crs[geographic] = 'EPSG:4326'
+    if 'x' in sites.columns and 'y' in sites.columns:
+        if 'crs' not in sites.columns:
+            raise Exception("Site registry has x/y columns but no crs column")
+        projected = crs.isna() & sites['x'].notna() & sites['y'].notna()
+        x[projected] = sites['x'][projected]; y[projected] = sites['y'][projected]
+        crs[projected] = sites['crs'][projected]
+    if crs.isna().any():
+        raise Exception("Sites without lat/lon or x/y/crs: "+', '.join(sites['name'][crs.isna()].astype(str)))
+    return pd.DataFrame({'name':sites['name'].astype(str), 'x':x.astype(np.float64),
+                         'y':y.astype(np.float64), 'crs':crs})
+
+class SiteIndex:
+    """
+    Finds the registry sites that fall inside a raster grid. Site coordinates
+    are projected to each grid CRS once and kept sorted by x, so a query is a
+    binary search on x plus a filter on y.
+
+    Parameters
+    ----------
+    registry : data frame from read_site_registry
+
+    """
+    def __init__(self,registry):
+        self.registry = registry.reset_index(drop=True)
+        self.projected = {}
+
+    def projected_sites(self,crs):
+        """
+        Returns (order, x, y): site indices sorted by x and their coordinates in crs
+        """
+        from rasterio.crs import CRS
+        from rasterio.warp import transform as transform_coordinates
+        key = str(crs)
+        if key not in self.projected:
+            dst_crs = CRS.from_user_input(crs)
+            x = np.empty(len(self.registry)); y = np.empty(len(self.registry))
+            for src_crs,group in self.registry.groupby('crs').groups.items():
+                xs,ys = transform_coordinates(CRS.from_user_input(src_crs), dst_crs,
+                                              self.registry['x'][group].tolist(), self.registry['y'][group].tolist())
+                x[group] = xs; y[group] = ys
+            order = np.argsort(x, kind='stable')
+            self.projected[key] = (order, x[order], y[order])
+        return self.projected[key]
+
+    def sites_in_grid(self,crs,transform,width,height):
+        """
+        Parameters
+        ----------
+        crs : CRS of the grid
+        transform : affine transform of the grid (north-up)
+        width : number of columns in the grid
+        height : number of rows in the grid
+
+        Returns
+        -------
+        rows_cols : dictionary of site name -> (row, col) for the sites whose
+            whole 3x4 window lies inside the grid
+
+        """
+        order,x,y = self.projected_sites(crs)
+        left,top = transform * (0, 0)
+        right,bottom = transform * (width, height)
+        start,stop = np.searchsorted(x, [min(left,right), max(left,right)], side='left')
+        in_y = (y[start:stop] >= min(top,bottom)) & (y[start:stop] < max(top,bottom))
+        sites = order[start:stop][in_y]
+        cols,rows = ~transform * (x[start:stop][in_y], y[start:stop][in_y])
+        rows = np.floor(rows).astype(int); cols = np.floor(cols).astype(int)
+        fits = ((rows >= window_margin['top']) & (rows < height-window_margin['bottom']) &
+                (cols >= window_margin['left']) & (cols < width-window_margin['right']))
+        names = self.registry['name'].to_numpy()
+        # Keep registry order, so outputs do not depend on the coordinates
+        return {names[site]:(int(rows[i]),int(cols[i])) for i,site in sorted(enumerate(sites), key=lambda item: item[1]) if fits[i]}
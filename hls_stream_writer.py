@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked output files for import_HLS_pixel_data.py --stream
+
+A StreamWriter appends one chunk of rows at a time to '.part' files next to
+the final outputs, so only one chunk has to be held in memory:
+    CSV files     : rows are appended, the header is written with the first
+                    chunk and the index continues across chunks
+    Parquet files : each chunk is a row group (requires pyarrow)
+    window stores : the int16 data and bool mask of each chunk are appended as
+                    raw bytes, and the meta rows to the meta CSV (see
+                    hls_window_store.py)
+finalize() writes the .npy headers, then moves every file into place, so
+readers never see a partial output, and a crashed run leaves the previous
+outputs untouched. The files are identical to writing all rows at once.
+"""
+
+# Imports
+import os
+import shutil
+import numpy as np
+from hls_window_store import frame_to_arrays
+
+# Functions
+def write_npy_from_raw(filename,raw_filename,dtype,shape):
+    """
+    Writes a .npy file with the given dtype and shape whose data is the raw
+    bytes in raw_filename, copying them in blocks
+    """
+    with open(filename,'wb') as f, open(raw_filename,'rb') as raw:
+        np.lib.format.write_array_header_1_0(f, {'descr':np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                 'fortran_order':False, 'shape':shape})
+        shutil.copyfileobj(raw, f)
+
+class StreamWriter:
+    """
+    Appends chunks of rows to a phenocam's output files and moves them into
+    place when finalized
+
+    Parameters
+    ----------
+    prefix : string, path of the outputs without suffix (e.g. output_dir+phenocam)
+
+    """
+    def __init__(self,prefix):
+        self.prefix = prefix
+        self.csv_rows = {}
+        self.parquet_writers = {}
+        self.parquet_empty = {}
+        self.window_scenes = None
+        self.window_shape = None
+        self.parts = []
+
+    def part_name(self,suffix):
+        """
+        Returns the .part file name of an output, remembering it for finalize
+        """
+        filename = self.prefix+suffix+'.part'
+        if filename not in self.parts:
+            self.parts.append(filename)
+        return filename
+
+    def append_csv(self,suffix,df):
+        """
+        Appends the rows of df to <prefix><suffix> (e.g. '_center.csv'), with the
+        index continuing from the previous chunk
+        """
+        start = self.csv_rows.get(suffix)
+        df = df.set_axis(np.arange(start or 0, (start or 0)+len(df)))
+        df.to_csv(self.part_name(suffix), mode='w' if start is None else 'a', header=start is None)
+        self.csv_rows[suffix] = (start or 0)+len(df)
+
+    def append_parquet(self,suffix,df):
+        """
+        Appends the rows of df to <prefix><suffix> (e.g. '_center.parquet') as a
+        row group. Empty chunks are skipped, as their object columns have no
+        type to fix the file's schema; if every chunk is empty, finalize writes
+        the empty frame.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if len(df) == 0:
+            self.parquet_empty.setdefault(suffix, df)
+            self.part_name(suffix)
+            return
+        if suffix not in self.parquet_writers:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.parquet_writers[suffix] = pq.ParquetWriter(self.part_name(suffix), table.schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self.parquet_writers[suffix].schema, preserve_index=False)
+        self.parquet_writers[suffix].write_table(table)
+
+    def append_windows(self,df_window):
+        """
+        Appends the rows of a window data frame to the <prefix>_window array store
+        """
+        data,mask,meta = frame_to_arrays(df_window)
+        first = self.window_scenes is None
+        with open(self.part_name('_window.npy'), 'wb' if first else 'ab') as f:
+            f.write(np.ascontiguousarray(data).tobytes())
+        with open(self.part_name('_window_mask.npy'), 'wb' if first else 'ab') as f:
+            f.write(np.ascontiguousarray(mask).tobytes())
+        meta.to_csv(self.part_name('_window_meta.csv'), mode='w' if first else 'a', header=first, index=False)
+        self.window_scenes = (0 if first else self.window_scenes)+len(data)
+        self.window_shape = data.shape[1:]
+
+    def finalize(self):
+        """
+        Closes the Parquet files, turns the raw window parts into .npy files,
+        and moves every part to its final name
+        """
+        for writer in self.parquet_writers.values():
+            writer.close()
+        for suffix,df in self.parquet_empty.items():
+            if suffix not in self.parquet_writers:
+                df.to_parquet(self.part_name(suffix), engine='pyarrow', index=False)
+        if self.window_scenes is not None:
+            shape = (self.window_scenes,)+tuple(self.window_shape)
+            for suffix,dtype in (('_window.npy',np.int16),('_window_mask.npy',np.bool_)):
+                raw = self.prefix+suffix+'.part'
+                write_npy_from_raw(raw+'.npy', raw, dtype, shape)
+                os.replace(raw+'.npy', raw)
+        for filename in self.parts:
+            os.replace(filename, filename[:-len('.part')])
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Array-backed storage for the HLS pixel windows written by import_HLS_pixel_data.py
+
+A phenocam's windows are stored as three files sharing a prefix
+(e.g. data/outputs_HLS/ibp_window):
+    <prefix>.npy      : int16 array of shape (scenes, bands, 12 pixels)
+    <prefix>_mask.npy : bool array of the same shape, True where a pixel is
+                        nodata (-9999) or the band is missing for the sensor
+    <prefix>_meta.csv : one row per scene with Year, DOY, Satellite, Phenocam
+                        and any other non-band columns (e.g. SkipReason)
+
+Bands are in the order of window_bands. The .npy files can be memory mapped,
+so one band or a range of scenes can be sliced without reading the rest.
+
+Run as a script to convert existing *_window.pkl files:
+    python hls_window_store.py data/outputs_HLS/*_window.pkl
+"""
+
+# Imports
+import argparse
+import os
+import numpy as np
+
+# Band order of the window arrays (the band columns of the *_window.pkl files)
+window_bands = ('CoastalAerosol',
+                'Blue',
+                'Green',
+                'Red',
+                'RedEdge1',
+                'RedEdge2',
+                'RedEdge3',
+                'NIRBroad',
+                'NIRNarrow',
+                'SWIR1',
+                'SWIR2',
+                'WaterVapor',
+                'Cirrus',
+                'TIR1',
+                'TIR2',
+                'Quality')
+meta_columns = ('Year','DOY','Satellite','Phenocam')
+nodata = -9999
+
+# Functions
+def frame_to_arrays(df_window):
+    """
+    Parameters
+    ----------
+    df_window : window data frame, one row per scene, band columns holding
+        12-pixel arrays or None
+
+    Returns
+    -------
+    data : int16 array of shape (scenes, bands, 12), -9999 where there is no data
+    mask : bool array of shape (scenes, bands, 12), True where there is no data
+    meta : data frame of the non-band columns (Year, DOY, Satellite, Phenocam, ...)
+        for each scene
+
+    """
+    data = np.full((len(df_window),len(window_bands),12), nodata, dtype=np.int16)
+    for b,band in enumerate(window_bands):
+        windows = df_window[band].to_numpy()
+        rows = np.flatnonzero([w is not None for w in windows])
+        if len(rows) > 0:
+            data[rows,b,:] = np.stack(windows[rows]).reshape(len(rows),12)
+    mask = data == nodata
+    meta = df_window.drop(columns=list(window_bands)).reset_index(drop=True)
+    return data,mask,meta
+
+def arrays_to_frame(data,mask,meta):
+    """
+    Parameters
+    ----------
+    data, mask, meta : arrays and metadata as returned by frame_to_arrays
+
+    Returns
+    -------
+    df_window : window data frame in the layout of the *_window.pkl files
+        (meta_columns, bands, then any other metadata columns); a band whose
+        12 pixels are all masked is None
+
+    """
+    meta = meta.reset_index(drop=True)
+    df_window = meta[list(meta_columns)].copy()
+    for b,band in enumerate(window_bands):
+        dtype = np.uint8 if band == 'Quality' else np.int16
+        empty = mask[:,b,:].all(axis=1)
+        df_window[band] = [None if empty[i] else np.array(data[i,b,:], dtype=dtype) for i in range(len(meta))]
+    for c in meta.columns.difference(meta_columns, sort=False):
+        df_window[c] = meta[c]
+    return df_window
+
+def save_array(filename,array):
+    """
+    Writes an array to a .npy file through a temporary file, so readers never
+    see a partially written file
+    """
+    with open(filename+'.tmp','wb') as f:
+        np.save(f, array)
+    os.replace(filename+'.tmp', filename)
+
+def write_window_store(prefix,df_window):
+    """
+    Parameters
+    ----------
+    prefix : string, path of the store without extension (e.g. output_dir+phenocam+'_window')
+    df_window : window data frame to store
+
+    """
+    data,mask,meta = frame_to_arrays(df_window)
+    save_array(prefix+'.npy', data)
+    save_array(prefix+'_mask.npy', mask)
+    meta.to_csv(prefix+'_meta.csv.tmp', index=False)
+    os.replace(prefix+'_meta.csv.tmp', prefix+'_meta.csv')
+
+def read_window_store(prefix,mmap=True):
+    """
+    Parameters
+    ----------
+    prefix : string, path of the store without extension
+    mmap : whether to memory map the arrays (read-only) instead of loading them
+
+    Returns
+    -------
+    data : int16 array of shape (scenes, bands, 12)
+    mask : bool array of shape (scenes, bands, 12), True where there is no data
+    meta : data frame of the non-band columns for each scene
+
+    """
+    import pandas as pd
+    mmap_mode = 'r' if mmap else None
+    data = np.load(prefix+'.npy', mmap_mode=mmap_mode)
+    mask = np.load(prefix+'_mask.npy', mmap_mode=mmap_mode)
+    meta = pd.read_csv(prefix+'_meta.csv', keep_default_na=False)
+    return data,mask,meta
+
+def window_store_exists(prefix):
+    """
+    Returns True if all three files of the store exist
+    """
+    return all(os.path.exists(prefix+suffix) for suffix in ('.npy','_mask.npy','_meta.csv'))
+
+"""
+Convert *_window.pkl files given on the command line
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert *_window.pkl files to window array stores")
+    parser.add_argument("pkl_files",type=str,nargs='+')
+    args = parser.parse_args()
+    import pandas as pd
+    for pkl_file in args.pkl_files:
+        prefix = pkl_file[:-len('.pkl')] if pkl_file.endswith('.pkl') else pkl_file
+        write_window_store(prefix, pd.read_pickle(pkl_file))
+        print(pkl_file+" -> "+prefix+".npy")
@@ -9,16 +9,93 @@ This code imports the pixel data from HLS imagery for v2.0
 
 # Imports
 import argparse
+from collections import deque
+import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import os
+import threading
+import time
 import numpy as np
-import rasterio
-from rasterio.windows import Window
-import pandas as pd
+# rasterio and pandas are imported by the functions using them, so --help,
+# --dry-run and importing this module as a library start quickly
+from hls_block_reader import BlockReader
+from hls_catalog import open_catalog, parse_granule_name, query_granules, refresh_catalog, return_stale_reasons, return_tile_dirs
+from hls_metrics import Metrics, Progress, timed
+from hls_stream_writer import StreamWriter
+from hls_sites import read_site_registry, SiteIndex, window_margin
+from hls_window_store import read_window_store, arrays_to_frame, frame_to_arrays, write_window_store, window_store_exists, window_bands
 
-# Read in command line arguments. Expecting a year value.
+# Command line arguments. Expecting one or more phenocam names, or --all.
 parser = argparse.ArgumentParser()
-parser.add_argument("phen_name",type=str)
-args = parser.parse_args()
+parser.add_argument("phen_name",type=str,nargs='*',
+                    help="name(s) of the phenocam(s) to extract; each band file is opened once for all of them")
+parser.add_argument("--all",action='store_true',
+                    help="extract every phenocam known to return_phenocam_row_col (or every site in --sites)")
+parser.add_argument("--sites",type=str,default=None,
+                    help="CSV site registry (name plus lat/lon or x/y/crs, see hls_sites.py) to use "
+                         "instead of the built-in phenocam pixel table")
+parser.add_argument("--catalog",type=str,default=None,
+                    help="SQLite granule catalog (see hls_catalog.py) to list granules from instead of "
+                         "walking the archive; built on first use, with a warning when it may be out "
+                         "of date")
+parser.add_argument("--refresh-catalog",action='store_true',
+                    help="with --catalog, pick up granules added, changed or removed since the catalog was built")
+parser.add_argument("--start",type=str,default=None,
+                    help="first date to extract, YYYY-MM-DD or YYYYDDD")
+parser.add_argument("--end",type=str,default=None,
+                    help="last date to extract, YYYY-MM-DD or YYYYDDD")
+parser.add_argument("--sensors",type=str,nargs='+',choices=('L30','S30'),default=None,
+                    help="only extract these sensors (default both)")
+parser.add_argument("--tiles",type=str,nargs='+',default=None,
+                    help="only extract these tiles, e.g. T13SCS (default every tile holding a site; a "
+                         "site in two tiles keeps, for each date, the row with the most valid pixels)")
+parser.add_argument("--workers",type=int,default=1,
+                    help="number of processes reading granules in parallel (default 1, no pool); "
+                         "the outputs are byte-identical for any number")
+parser.add_argument("--io-threads",type=int,default=0,
+                    help="with --workers 1, number of threads reading the next granules while the "
+                         "current one is processed (default 0, read each granule when it is needed)")
+parser.add_argument("--prefetch",type=int,default=None,
+                    help="with --io-threads, number of granules read ahead of the one being "
+                         "processed (default twice --io-threads)")
+parser.add_argument("--window-format",choices=('pickle','array'),default=None,
+                    help="store windows as <phenocam>_window.pkl (default) or as memory-mappable "
+                         "int16 arrays, see hls_window_store.py (default with --stream)")
+parser.add_argument("--stream",type=int,nargs='?',const=1000,default=None,
+                    help="write the outputs in chunks of this many rows per phenocam while "
+                         "extracting (default when given without a value: 1000), so memory does not "
+                         "grow with the archive; files are moved into place at the end "
+                         "(see hls_stream_writer.py). Windows are stored as arrays")
+parser.add_argument("--qa-skip",type=str,nargs='?',const='fill,cloud,adjacent,shadow,aerosol_high',default=None,
+                    help="read the Fmask band first and skip the other bands for a phenocam whose "
+                         "center pixel has any of these comma-separated conditions: "
+                         "fill, cirrus, cloud, adjacent, shadow, snow, water, aerosol_high "
+                         "(default when given without a value: fill,cloud,adjacent,shadow,aerosol_high, "
+                         "the scenes import_hls_data.R removes). Skipped scenes are still written, "
+                         "with the conditions in the SkipReason column")
+parser.add_argument("--parquet",action='store_true',
+                    help="also write <phenocam>_center.parquet and _north.parquet with GCC, NDVI, EVI "
+                         "and Fmask bit columns, ready for import_hls_data.R (needs pyarrow)")
+parser.add_argument("--incremental",action='store_true',
+                    help="only read granules that are new, changed or read with another --qa-skip since "
+                         "the last run (per the _manifest.csv files) and merge them into the existing "
+                         "outputs; rows of granules no longer listed are dropped")
+parser.add_argument("--profile",action='store_true',
+                    help="time each stage of the run (listing, opening, reading, statistics, output) "
+                         "and count granules, files opened and bytes read; prints a summary at the end")
+parser.add_argument("--metrics-out",type=str,default=None,
+                    help="write the --profile report to this JSON file (implies --profile)")
+parser.add_argument("--progress",type=float,default=0,
+                    help="print a progress line with throughput and ETA every N seconds (default 0, off)")
+parser.add_argument("--dry-run",action='store_true',
+                    help="print the granules that would be read (with --incremental, the new or "
+                         "changed ones) and exit without reading them")
+parser.add_argument("--checkpoint-every",type=int,default=500,
+                    help="with --incremental, save outputs and manifests every N granules so a "
+                         "crashed run resumes from there (default 500)")
+parser.add_argument("--root",type=str,default=None,
+                    help="directory holding the L30 and S30 folders of the bulk download "
+                         "(default image_path_1)")
 
 # Functions
 def return_year_doy(image_name):
@@ -33,9 +110,38 @@ def return_year_doy(image_name):
     doy : int of the day of year the image was collected
 
     """
-    year = int(image_name[15:19])
-    doy = int(image_name[19:22])
-    return year,doy
+    granule = parse_granule_name(image_name)
+    return granule['year'],granule['doy']
+
+def return_tile(image_name):
+    """
+    Parameters
+    ----------
+    image_name : string containing the name of an HLS image
+
+    Returns
+    -------
+    tile : string of the MGRS tile of the image, e.g. 'T13SCS'
+
+    """
+    tile = parse_granule_name(image_name)['tile']
+    return tile
+
+def return_date_year_doy(date):
+    """
+    Parameters
+    ----------
+    date : string containing a date as YYYY-MM-DD or YYYYDDD (year and day of year)
+
+    Returns
+    -------
+    year, doy : ints of the year and day of year of the date
+
+    """
+    if len(date) == 7 and date.isdigit():
+        return int(date[:4]),int(date[4:])
+    date = datetime.date.fromisoformat(date)
+    return date.year,date.timetuple().tm_yday
 
 def create_image_path(path1,path2,S30_or_L30,year):
     """
@@ -56,6 +162,44 @@ def create_image_path(path1,path2,S30_or_L30,year):
     image_path = path1+S30_or_L30+'/'+year+path2
     return image_path
 
+def read_phenocam_window(src,row,col,flatten=True):
+    """
+    Parameters
+    ----------
+    src : open rasterio dataset
+    row : row of target phenocam
+    col : col of target phenocam
+    flatten : whether or not the returned pixels will be flattened to a single dimension
+
+    Returns
+    -------
+    w : the twelve-pixel window around the phenocam of interest, None if all pixels are fill
+
+    """
+    from rasterio.windows import Window
+    w = src.read(window = Window(col-1,row-2,3,4))
+    return return_window_pixels(w,flatten)
+
+def return_window_pixels(w,flatten=True):
+    """
+    Parameters
+    ----------
+    w : array of the 3x4 pixels read around a phenocam
+    flatten : whether or not the returned pixels will be flattened to a single dimension
+
+    Returns
+    -------
+    w : the twelve-pixel window, None if all pixels are fill
+
+    """
+    w = np.squeeze(w)
+    w_flat = np.ndarray.flatten(w)
+    if flatten == True:
+        w = w_flat
+    if np.mean(w_flat) == -9999:
+        w = None
+    return w
+
 def return_phenocam_pixels(row,col,image_path,flatten=True):
     """
     Parameters
@@ -68,18 +212,70 @@ def return_phenocam_pixels(row,col,image_path,flatten=True):
     Returns
     -------
     w : the twelve-pixel window around the phenocam of interest
-    
+
     """
+    import rasterio
     with rasterio.open(image_path,driver='GTiff') as src:
-        w = src.read(window = Window(col-1,row-2,3,4))
-        w = np.squeeze(w)
-        w_flat = np.ndarray.flatten(w)
-        if flatten == True:
-            w = w_flat
-        if np.mean(w_flat) == -9999:
-            w = None
+        w = read_phenocam_window(src,row,col,flatten)
     return w
 
+def return_phenocam_pixels_multi(rows_cols,image_path,flatten=True):
+    """
+    Parameters
+    ----------
+    rows_cols : dictionary of phenocam name -> (row, col)
+    image_path : string containing the path to the image
+    flatten : whether or not the returned pixels will be flattened to a single dimension
+
+    Returns
+    -------
+    windows : dictionary of phenocam name -> twelve-pixel window, all read
+        from a single open of the image. Nearby phenocams are read together in
+        block-aligned reads, so each internal block is decompressed once
+        (see hls_block_reader.py).
+
+    """
+    import rasterio
+    with timed(worker_metrics,'open'):
+        src = rasterio.open(image_path,driver='GTiff')
+    with src, timed(worker_metrics,'read'):
+        reader = BlockReader(src, count_bytes=worker_metrics is not None)
+        pixels = reader.read_windows({name:(row-2,col-1,4,3) for name,(row,col) in rows_cols.items()})
+    if worker_metrics is not None:
+        worker_metrics.count('files_opened')
+        worker_metrics.count('blocks_read', reader.blocks_read)
+        worker_metrics.count('bytes_read', reader.bytes_read)
+    windows = {name:return_window_pixels(w,flatten) for name,w in pixels.items()}
+    return windows
+
+def return_mean_std_batch(w,mask):
+    """
+    Parameters
+    ----------
+    w : numpy array of 12-pixel windows, shape (..., 12), e.g. (scenes, bands, 12)
+    mask : boolean array of the same shape, True for pixels with no data (-9999)
+
+    Returns
+    -------
+    stats : dictionary with 'north' and 'center' entries of (mean, std, count).
+        Each is an array of shape w.shape[:-1]; only unmasked pixels are used,
+        count is the number of them, and mean/std are NaN where it is 0.
+
+    """
+    valid = ~mask
+    w = np.where(valid, w, 0).astype(np.float64)
+    stats = {}
+    for region,pixels in (('north',slice(0,9)),('center',slice(3,12))):
+        w_region = w[...,pixels]
+        valid_region = valid[...,pixels]
+        count = np.count_nonzero(valid_region, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.sum(w_region, axis=-1)/count
+            deviation = np.where(valid_region, w_region-mean[...,np.newaxis], 0)
+            std = np.sqrt(np.sum(deviation*deviation, axis=-1)/count)
+        stats[region] = (mean,std,count)
+    return stats
+
 def return_mean_std(w):
     """
     Parameters
@@ -93,6 +289,8 @@ def return_mean_std(w):
     std_north : the standard deviation of the pixels around and north of the phenocam
     std_center : the standard deviation of the pixels around the phenocam
 
+    Pixels equal to -9999 are left out of the means and standard deviations.
+
     """
     if w is None:
         mean_north = None; mean_center = None; std_north = None; std_center = None;
@@ -100,12 +298,69 @@ def return_mean_std(w):
         w_flat = np.ndarray.flatten(w)
         if np.size(w_flat) != 12:
             raise Exception("Input array is not the expected size")
-        mean_north = np.mean(w_flat[0:9])
-        mean_center = np.mean(w_flat[3:12])
-        std_north = np.std(w_flat[0:9])
-        std_center = np.std(w_flat[3:12])
+        stats = return_mean_std_batch(w_flat, w_flat == -9999)
+        mean_north,std_north,count_north = stats['north']
+        mean_center,std_center,count_center = stats['center']
+        mean_north = mean_north[()]; mean_center = mean_center[()]
+        std_north = std_north[()]; std_center = std_center[()]
     return mean_north,mean_center,std_north,std_center
 
+# Fmask bit of each QA condition (HLS v2.0). Aerosol level is bits 6-7, and is
+# high when both are set. A value of 255 is fill.
+qa_bits = {'cirrus':0, 'cloud':1, 'adjacent':2, 'shadow':3, 'snow':4, 'water':5}
+
+def return_qa_conditions(qa):
+    """
+    Parameters
+    ----------
+    qa : Fmask value, or numpy array of Fmask values
+
+    Returns
+    -------
+    conditions : dictionary of condition name -> boolean (array), for 'fill',
+        'aerosol_high' and each condition in qa_bits. Fill values have only
+        'fill' set.
+
+    """
+    qa = np.asarray(qa).astype(np.uint8)
+    fill = qa == 255
+    conditions = {'fill':fill}
+    for name,bit in qa_bits.items():
+        conditions[name] = ((qa >> bit) & 1).astype(bool) & ~fill
+    conditions['aerosol_high'] = ((qa >> 6) & 3 == 3) & ~fill
+    return conditions
+
+def return_qa_skip_reason(qa,qa_policy):
+    """
+    Parameters
+    ----------
+    qa : Fmask value of a phenocam's center pixel
+    qa_policy : list of condition names (see return_qa_conditions) that cause a skip
+
+    Returns
+    -------
+    reason : string of the policy conditions that are set, separated by ';',
+        or '' if the pixel passes
+
+    """
+    conditions = return_qa_conditions(qa)
+    return ';'.join(name for name in qa_policy if conditions[name])
+
+# Pixel row/col of each phenocam in tile 13SCS
+phenocam_tile = 'T13SCS'
+phenocam_rows_cols = {'jershrubland':(2809, 922),
+                      'jershrubland2':(2817, 943),
+                      'jernovel':(2892, 917),
+                      'jernovel2':(2881, 935),
+                      'jergrassland':(3112, 930),
+                      'jergrassland2':(3109, 953),
+                      'jerbajada':(3137, 1554),
+                      'jernort':(2987, 1074),
+                      'ibp':(3088, 894),
+                      'jernwern':(2957, 1229),
+                      'NEON.D14.JORN.DP1.00033':(3086, 902),
+                      'jersand':(3370, 1063)}
+
 def return_phenocam_row_col(phenocam_name):
     """
     Parameters
@@ -114,388 +369,1277 @@ def return_phenocam_row_col(phenocam_name):
 
     Returns
     -------
-    lat : latitude of input phenocam
-    lon : longitude of input phenocam
-
-    """
-    if phenocam_name == 'jershrubland':
-        row,col = 2809, 922
-    elif phenocam_name == 'jershrubland2':
-        row,col = 2817, 943
-    elif phenocam_name == 'jernovel':
-        row,col = 2892, 917
-    elif phenocam_name == 'jernovel2':
-        row,col = 2881, 935
-    elif phenocam_name == 'jergrassland':
-        row,col = 3112, 930
-    elif phenocam_name == 'jergrassland2':
-        row,col = 3109, 953
-    elif phenocam_name == 'jerbajada':
-        row,col = 3137, 1554
-    elif phenocam_name == 'jernort':
-        row,col = 2987, 1074
-    elif phenocam_name == 'ibp':
-        row,col = 3088, 894
-    elif phenocam_name == 'jernwern':
-        row,col = 2957, 1229
-    elif phenocam_name == 'NEON.D14.JORN.DP1.00033':
-        row,col = 3086, 902
-    elif phenocam_name == 'jersand':
-        row,col = 3370, 1063
-    else:
+    row : pixel row of input phenocam
+    col : pixel column of input phenocam
+
+    """
+    if phenocam_name not in phenocam_rows_cols:
         raise Exception("Phenocam name not recognized")
+    row,col = phenocam_rows_cols[phenocam_name]
     return row,col
 
+def return_granule_windows(rows_cols,temp_path,bands,qa_policy=None):
+    """
+    Parameters
+    ----------
+    rows_cols : dictionary of phenocam name -> (row, col)
+    temp_path : string containing the path to a granule, without the band suffix
+    bands : dictionary of band name -> band file suffix for this sensor
+    qa_policy : optional list of QA conditions. If given, the Fmask band is read
+        first, and the other bands are only read for phenocams whose center
+        pixel has none of the conditions.
+
+    Returns
+    -------
+    windows : dictionary of phenocam name -> dictionary of band name -> window,
+        plus 'SkipReason' (see return_qa_skip_reason). Bands in window_bands that
+        the sensor does not have, or that were skipped, are None. Each band
+        file is opened once for all phenocams, and not at all if every
+        phenocam was skipped.
+
+    """
+    windows = {name:dict.fromkeys(window_bands) for name in rows_cols}
+    for name in rows_cols:
+        windows[name]['SkipReason'] = ''
+    if qa_policy:
+        quality = return_phenocam_pixels_multi(rows_cols, temp_path+'.'+bands['Quality']+'.tif')
+        for name in rows_cols:
+            windows[name]['Quality'] = quality[name]
+            windows[name]['SkipReason'] = return_qa_skip_reason(quality[name][7], qa_policy)
+        rows_cols = {name:row_col for name,row_col in rows_cols.items() if not windows[name]['SkipReason']}
+        bands = {band:suffix for band,suffix in bands.items() if band != 'Quality'}
+    for band,suffix in bands.items():
+        if not rows_cols:
+            break
+        band_windows = return_phenocam_pixels_multi(rows_cols, temp_path+'.'+suffix+'.tif')
+        for name in rows_cols:
+            windows[name][band] = band_windows[name]
+    return windows
+
+def return_center_north_frames(df_window):
+    """
+    Parameters
+    ----------
+    df_window : window data frame, one row per scene
+
+    Returns
+    -------
+    df_center : data frame of the center mean/std/count of each band, and the center Quality value
+    df_north : data frame of the north mean/std/count of each band, and the center Quality value
+
+    The statistics for all scenes and bands are computed in one vectorized pass
+    over the stacked windows, with -9999 pixels masked out.
+
+    """
+    import pandas as pd
+    data,mask,meta = frame_to_arrays(df_window)
+    stats = return_mean_std_batch(data, mask)
+    frames = {}
+    for region in ('center','north'):
+        mean,std,count = stats[region]
+        columns = {'Year':meta['Year'].to_numpy(dtype=np.int64),
+                   'DOY':meta['DOY'].to_numpy(dtype=np.int64),
+                   'Satellite':meta['Satellite'].to_numpy(dtype=object),
+                   'Phenocam':meta['Phenocam'].to_numpy(dtype=object),
+                   'CenterOrNorth':np.full(len(meta), region, dtype=object)}
+        for band in meanstd_band_names:
+            b = window_bands.index(band)
+            columns[band+'_mean'] = mean[:,b]
+            columns[band+'_std'] = std[:,b]
+            columns[band+'_count'] = count[:,b].astype(np.uint8)
+        columns['Quality'] = data[:,window_bands.index('Quality'),7].astype(np.uint8)
+        columns['SkipReason'] = meta['SkipReason'].to_numpy(dtype=object)
+        frames[region] = pd.DataFrame(columns, columns=meanstd_columns)
+    return frames['center'],frames['north']
+
+def calc_gcc(blue,green,red):
+    """
+    Returns the green chromatic coordinate, green/(blue+green+red)
+    """
+    return green/(blue+green+red)
+
+def calc_ndvi(red,nir):
+    """
+    Returns the NDVI, (NIR-red)/(NIR+red)
+    """
+    return (nir-red)/(nir+red)
+
+def calc_evi(blue,red,nir,L=1,C1=6,C2=7.5,G=2.5):
+    """
+    Returns the EVI, G*(NIR-red)/(NIR+C1*red-C2*blue+L)
+    """
+    return G*(nir-red)/(nir+C1*red-C2*blue+L)
+
+# Output column name and Fmask bit of each QA flag, as in import_hls_data.R
+# (bits are read from the raw Quality value, so fill (255) has every flag set)
+analysis_qa_bits = {'Aerosol1':7, 'Aerosol2':6, 'Water':5, 'Snow':4, 'CloudShadow':3, 'CloudAdjacent':2, 'Cloud':1}
+
+def return_analysis_frame(df_meanstd):
+    """
+    Parameters
+    ----------
+    df_meanstd : center or north data frame
+
+    Returns
+    -------
+    df : data frame with the columns hls_csv_to_df in import_hls_data.R builds
+        (except ECO_STATE): DATE, YEAR, DOY, PHENOCAM_NAME, SATELLITE, GCC, NDVI,
+        EVI, band standard deviations, and one boolean column per QA flag.
+        Rows without a Red mean are dropped, as in hls_csv_to_df.
+
+    """
+    import pandas as pd
+    df_meanstd = df_meanstd[df_meanstd['Red_mean'].notna()]
+    blue = df_meanstd['Blue_mean'].to_numpy(dtype=np.float64)
+    green = df_meanstd['Green_mean'].to_numpy(dtype=np.float64)
+    red = df_meanstd['Red_mean'].to_numpy(dtype=np.float64)
+    nir = df_meanstd['NIRNarrow_mean'].to_numpy(dtype=np.float64)
+    year = df_meanstd['Year'].to_numpy(dtype=np.int32)
+    doy = df_meanstd['DOY'].to_numpy(dtype=np.int32)
+    date = (year-1970).astype('datetime64[Y]').astype('datetime64[D]')+(doy-1)
+    quality = df_meanstd['Quality'].to_numpy(dtype=np.uint8)
+    columns = {'DATE':pd.Series(date).dt.date,
+               'YEAR':year,
+               'DOY':doy,
+               'PHENOCAM_NAME':df_meanstd['Phenocam'].to_numpy(dtype=object),
+               'SATELLITE':df_meanstd['Satellite'].to_numpy(dtype=object),
+               'GCC':calc_gcc(blue,green,red),
+               'NDVI':calc_ndvi(red,nir),
+               'EVI':calc_evi(blue,red,nir),
+               'STD_B':df_meanstd['Blue_std'].to_numpy(dtype=np.float64),
+               'STD_G':df_meanstd['Green_std'].to_numpy(dtype=np.float64),
+               'STD_R':df_meanstd['Red_std'].to_numpy(dtype=np.float64),
+               'STD_NIR':df_meanstd['NIRNarrow_std'].to_numpy(dtype=np.float64)}
+    for name,bit in analysis_qa_bits.items():
+        columns[name] = ((quality >> bit) & 1).astype(bool)
+    return pd.DataFrame(columns)
+
+def return_tile_paths(satellite,years,root=None):
+    """
+    Parameters
+    ----------
+    satellite : string, 'L30' or 'S30'
+    years : list of years to look for imagery in
+    root : string the satellite folders are appended to (default image_path_1)
+
+    Returns
+    -------
+    tile_paths : list of (satellite, year, tile, tile directory) for every tile
+        in the bulk download tree (or only image_path_2, if set), e.g.
+        ('L30', 2016, 'T13SCS', root+'L30/2016/13/S/C/S')
+
+    """
+    root = image_path_1 if root is None else root
+    tile_paths = []
+    for year in years:
+        year_path = create_image_path(root, '', satellite, year)
+        if not os.path.isdir(year_path):
+            continue
+        tile_dirs = return_tile_dirs(year_path) if image_path_2 is None else [image_path_2]
+        for tile_dir in tile_dirs:
+            zone,band,square1,square2 = tile_dir.strip('/').split('/')
+            tile = 'T'+zone.zfill(2)+band+square1+square2
+            if os.path.isdir(year_path+tile_dir):
+                tile_paths.append((satellite,year,tile,year_path+tile_dir))
+    return tile_paths
+
+def return_first_granule(image_path):
+    """
+    Returns the path (without band suffix) of the first granule in a tile
+    directory, or None if it is empty
+    """
+    im_names = sorted(os.listdir(image_path))
+    if not im_names:
+        return None
+    return image_path+'/'+im_names[0]+'/'+im_names[0]
+
+def return_granule_list(tile_paths):
+    """
+    Parameters
+    ----------
+    tile_paths : list of (satellite, year, tile, tile directory) from return_tile_paths
+
+    Returns
+    -------
+    granules : list of (satellite, year, doy, granule path without band suffix),
+        sorted by year, DOY and then path so that the output order does not
+        depend on directory listing order
+
+    """
+    granules = []
+    for satellite,year,tile,image_path in tile_paths:
+        for im_name in os.listdir(image_path):
+            year,doy = return_year_doy(im_name)
+            granules.append((satellite,year,doy,image_path+'/'+im_name+'/'+im_name))
+    granules.sort()
+    return granules
+
+def return_tile_margin(row,col,width,height):
+    """
+    Returns the number of pixels between a site's 3x4 window and the nearest
+    edge of the tile
+    """
+    return min(row-window_margin['top'], height-1-window_margin['bottom']-row,
+               col-window_margin['left'], width-1-window_margin['right']-col)
+
+def return_tile_grid(temp_path):
+    """
+    Parameters
+    ----------
+    temp_path : string containing the path to a granule, without the band suffix
+
+    Returns
+    -------
+    crs, transform, width, height : grid of the granule's tile (read from its Fmask band)
+
+    """
+    import rasterio
+    with rasterio.open(temp_path+'.Fmask.tif',driver='GTiff') as src:
+        return src.crs,src.transform,src.width,src.height
+
+def init_worker(tile_rows_cols,qa_policy=None,profile=False):
+    """
+    Sets up a process for extract_granule_windows. The phenocam row/cols are
+    stored once per process rather than sent with every granule, and a
+    rasterio/GDAL environment is entered once and kept open for the life of the
+    process so it is not rebuilt for every band file (or every extraction, in
+    a process calling extract_sites repeatedly).
+
+    Parameters
+    ----------
+    tile_rows_cols : dictionary of tile -> dictionary of phenocam name -> (row, col)
+    qa_policy : optional list of QA conditions, see return_granule_windows
+    profile : whether to record stage times and counters (see hls_metrics.py)
+
+    """
+    global worker_tile_rows_cols, worker_qa_policy, worker_env, worker_metrics
+    import rasterio
+    worker_tile_rows_cols = tile_rows_cols
+    worker_qa_policy = qa_policy
+    worker_metrics = Metrics() if profile else None
+    if worker_env is None:
+        worker_env = rasterio.Env(**gdal_options)
+        worker_env.__enter__()
+
+def init_io_thread():
+    """
+    Enters a rasterio/GDAL environment in an I/O thread and keeps it open for
+    the life of the thread (rasterio environments are per thread)
+    """
+    import rasterio
+    io_thread_state.env = rasterio.Env(**gdal_options)
+    io_thread_state.env.__enter__()
+
+def submit_ahead(executor,function,items,depth):
+    """
+    Parameters
+    ----------
+    executor : thread or process pool
+    function : function to apply to each item
+    items : list of items
+    depth : number of items submitted ahead of the one being processed by the caller
+
+    Yields
+    ------
+    result : function(item) for each item, in the order of items. Unlike
+        executor.map, which submits every item at once and holds the results
+        the caller has not taken, at most depth+1 items are submitted or held.
+
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def prefetch_map(function,items,threads,depth):
+    """
+    Parameters
+    ----------
+    function : function to apply to each item (e.g. extract_granule_windows)
+    items : list of items
+    threads : number of threads applying function
+    depth : number of items read ahead of the one being processed by the caller
+
+    Yields
+    ------
+    result : function(item) for each item, in the order of items. While the
+        caller processes a result, the next depth items are read, so reads
+        stay a bounded distance ahead of the caller.
+
+    """
+    with ThreadPoolExecutor(max_workers=threads, initializer=init_io_thread) as executor:
+        yield from submit_ahead(executor, function, items, depth)
+
+def extract_granule_windows(granule):
+    """
+    Parameters
+    ----------
+    granule : (satellite, year, doy, granule path) tuple from return_granule_list
+
+    Returns
+    -------
+    windows : output of return_granule_windows for the phenocams in the granule's tile
+    metrics : stage times and counters recorded by this process since the
+        last granule (see Metrics.pop), None if not profiling
+
+    """
+    satellite,year,doy,temp_path = granule
+    rows_cols = worker_tile_rows_cols[return_tile(os.path.basename(temp_path))]
+    windows = return_granule_windows(rows_cols, temp_path, bands_by_satellite[satellite], worker_qa_policy)
+    return windows,(None if worker_metrics is None else worker_metrics.pop())
+
+class ResultBuilder:
+    """
+    Collects the rows of one output data frame into preallocated column arrays
+    and builds the data frame once at the end, instead of growing it with
+    pd.concat for every granule (which copies the whole frame each time).
+
+    Parameters
+    ----------
+    columns : sequence of column names, in output order
+    n_rows : number of rows to preallocate; grows by doubling if exceeded
+    dtypes : dictionary of column name -> numpy dtype. Float columns store
+        None as NaN; columns not listed are object columns.
+
+    """
+    def __init__(self,columns,n_rows,dtypes):
+        self.columns = list(columns)
+        self.n = 0
+        self.arrays = {c:self.empty_column(dtypes.get(c, object), n_rows) for c in self.columns}
+
+    @staticmethod
+    def empty_column(dtype,n_rows):
+        """
+        Returns an array of n_rows empty values: None for object columns,
+        NaN for float columns and 0 otherwise
+        """
+        if dtype == object:
+            return np.full(n_rows, None, dtype=object)
+        elif np.issubdtype(dtype, np.floating):
+            return np.full(n_rows, np.nan, dtype=dtype)
+        return np.zeros(n_rows, dtype=dtype)
+
+    def add_row(self,data):
+        """
+        Parameters
+        ----------
+        data : dictionary of column name -> value; missing columns keep their
+            empty value (None, or NaN for float columns)
+
+        """
+        if self.n == len(self.arrays[self.columns[0]]):
+            for c,a in self.arrays.items():
+                grown = self.empty_column(a.dtype, max(2*len(a),1))
+                grown[:len(a)] = a
+                self.arrays[c] = grown
+        for c,value in data.items():
+            self.arrays[c][self.n] = value
+        self.n += 1
+
+    def reset(self):
+        """
+        Drops the rows added so far, keeping the allocated size
+        """
+        self.arrays = {c:self.empty_column(a.dtype, len(a)) for c,a in self.arrays.items()}
+        self.n = 0
+
+    def to_frame(self):
+        """
+        Returns
+        -------
+        df : pandas data frame of the rows added so far
+
+        """
+        import pandas as pd
+        return pd.DataFrame({c:self.arrays[c][:self.n] for c in self.columns}, columns=self.columns)
+
+def return_granule_signature(temp_path):
+    """
+    Parameters
+    ----------
+    temp_path : string containing the path to a granule, without the band suffix
+
+    Returns
+    -------
+    mtime : latest modification time (ns) of the files in the granule directory
+    size : total size in bytes of the files in the granule directory
+
+    """
+    mtime = 0; size = 0
+    with os.scandir(os.path.dirname(temp_path)) as entries:
+        for entry in entries:
+            st = entry.stat()
+            mtime = max(mtime, st.st_mtime_ns)
+            size += st.st_size
+    return mtime,size
+
+def return_output_dir(directory=None):
+    """
+    Returns directory, or the module's output_dir if it is None
+    """
+    return output_dir if directory is None else directory
+
+def read_manifest(phenocam,window_format='pickle',directory=None):
+    """
+    Parameters
+    ----------
+    phenocam : string containing phenocam name
+    window_format : 'pickle' or 'array', how the windows are stored
+    directory : directory of the outputs (default output_dir)
+
+    Returns
+    -------
+    manifest : data frame of the granules already extracted for the phenocam
+        (see return_manifest), or None if the phenocam has no manifest and
+        outputs yet
+
+    """
+    import pandas as pd
+    directory = return_output_dir(directory)
+    manifest_filename = directory+phenocam+'_manifest.csv'
+    output_filenames = [directory+phenocam+suffix for suffix in ('_center.csv','_north.csv')]
+    if window_format == 'pickle':
+        window_exists = os.path.exists(directory+phenocam+'_window.pkl')
+    else:
+        window_exists = window_store_exists(directory+phenocam+'_window')
+    if not (window_exists and all(os.path.exists(f) for f in [manifest_filename]+output_filenames)):
+        return None
+    return pd.read_csv(manifest_filename)
+
+def read_results(phenocam,window_format='pickle',directory=None):
+    """
+    Parameters
+    ----------
+    phenocam : string containing phenocam name
+    window_format : 'pickle' or 'array', how the windows are stored
+    directory : directory of the outputs (default output_dir)
+
+    Returns
+    -------
+    df_window : the phenocam's existing window data frame
+
+    """
+    import pandas as pd
+    directory = return_output_dir(directory)
+    if window_format == 'pickle':
+        df_window = pd.read_pickle(directory+phenocam+'_window.pkl')
+    else:
+        df_window = arrays_to_frame(*read_window_store(directory+phenocam+'_window', mmap=False))
+    return df_window
+
+def merge_results(df_old,df_new,keys=('Satellite','Year','DOY')):
+    """
+    Parameters
+    ----------
+    df_old : data frame of previously extracted rows
+    df_new : data frame of newly extracted rows
+    keys : columns identifying a row
+
+    Returns
+    -------
+    df : rows of both, with df_new replacing old rows of the same keys
+        (Satellite/Year/DOY by default), sorted by keys
+
+    """
+    import pandas as pd
+    keys = list(keys)
+    replaced = pd.MultiIndex.from_frame(df_old[keys]).isin(pd.MultiIndex.from_frame(df_new[keys]))
+    df_old = df_old[~replaced].reindex(columns=df_new.columns).astype(df_new.dtypes.to_dict())
+    df = pd.concat([df_old,df_new],ignore_index=True)
+    df = df.sort_values(keys, kind='mergesort', ignore_index=True)
+    return df
+
+def drop_overlap_duplicates(df_window,tile_rank):
+    """
+    Parameters
+    ----------
+    df_window : window data frame of one site, with a row from each tile
+        covering the site for scenes in the overlap of tiles
+    tile_rank : dictionary of tile -> rank of the tile for this site (0 first)
+
+    Returns
+    -------
+    df_window : one row per Satellite/Year/DOY, keeping the row with the most
+        valid (not -9999) pixels, then the one from the best ranked tile;
+        sorted by Satellite/Year/DOY
+
+    """
+    keys = ['Satellite','Year','DOY']
+    data,mask,meta = frame_to_arrays(df_window)
+    spectral = [b for b,band in enumerate(window_bands) if band != 'Quality']
+    valid = (~mask[:,spectral,:]).sum(axis=(1,2))
+    # Negate the counts so an ascending sort puts the most valid pixels first
+    order = (df_window[keys].assign(Invalid=-valid, Rank=df_window['Tile'].map(tile_rank).to_numpy())
+             .sort_values(keys+['Invalid','Rank'], kind='mergesort').index)
+    df_window = df_window.loc[order]
+    return df_window[~df_window.duplicated(keys)].reset_index(drop=True)
+
+def return_pickle_windows(df_window):
+    """
+    Returns a copy of a window data frame with every column rebuilt in this
+    process: arrays are copied into arrays of numpy's own dtype objects, equal
+    strings share one object, and extension columns (e.g. pandas' str) and the
+    column labels are new arrays of pandas' own dtypes. Pickle's memo depends on
+    which objects are shared, so without this, windows returned by worker
+    processes or merged with an earlier pickle would be written with different
+    bytes than in a serial run.
+    """
+    import pandas as pd
+    def return_array_copy(v):
+        # np.array(v, dtype=...) would keep v's own (possibly unpickled) dtype object
+        copy = np.empty(v.shape, dtype=np.dtype(v.dtype.str))
+        copy[...] = v
+        return copy
+    strings = {}
+    columns = {}
+    for column in df_window.columns:
+        dtype = df_window[column].dtype
+        values = df_window[column].to_numpy()
+        if dtype == object:
+            rebuilt = np.empty(len(values), dtype=object)
+            for i,v in enumerate(values):
+                if isinstance(v,np.ndarray):
+                    rebuilt[i] = return_array_copy(v)
+                elif isinstance(v,str):
+                    rebuilt[i] = strings.setdefault(v, v)
+                else:
+                    rebuilt[i] = v
+            columns[column] = rebuilt
+        elif isinstance(dtype,np.dtype):
+            columns[column] = return_array_copy(values)
+        else:
+            columns[column] = pd.array(values, dtype=pd.api.types.pandas_dtype(dtype.name))
+    return pd.DataFrame(columns, columns=list(df_window.columns), index=df_window.index.copy())
+
+def save_results(phenocam,df_window,df_center,df_north,manifest,window_format='pickle',parquet=False,directory=None):
+    """
+    Writes a phenocam's outputs and then its manifest. Each file is written to a
+    temporary name and moved into place, so a crash never leaves a partial file,
+    and the manifest never lists granules missing from the outputs.
+
+    Parameters
+    ----------
+    phenocam : string containing phenocam name
+    df_window, df_center, df_north : output data frames
+    manifest : data frame of the granules the outputs cover
+    window_format : 'pickle' or 'array', how the windows are stored
+    parquet : whether to also write the analysis frames (see return_analysis_frame)
+        to <phenocam>_center.parquet and _north.parquet
+    directory : directory to write to (default output_dir)
+
+    """
+    directory = return_output_dir(directory)
+    if window_format == 'array':
+        write_window_store(directory+phenocam+'_window', df_window)
+    outputs = ((df_center,'_center.csv'),(df_north,'_north.csv'),(manifest,'_manifest.csv'))
+    if parquet:
+        outputs = ((return_analysis_frame(df_center),'_center.parquet'),
+                   (return_analysis_frame(df_north),'_north.parquet'))+outputs
+    if window_format == 'pickle':
+        outputs = ((df_window,'_window.pkl'),)+outputs
+    for df,suffix in outputs:
+        filename = directory+phenocam+suffix
+        if suffix.endswith('.pkl'):
+            return_pickle_windows(df).to_pickle(filename+'.tmp')
+        elif suffix.endswith('.parquet'):
+            df.to_parquet(filename+'.tmp', engine='pyarrow', index=False)
+        elif suffix == '_manifest.csv':
+            df.to_csv(filename+'.tmp', index=False)
+        else:
+            df.to_csv(filename+'.tmp')
+        os.replace(filename+'.tmp', filename)
+
+class ExtractionPlan:
+    """
+    Finds the tiles and granules to read for a set of sites, and where each
+    site is in each tile. Registry sites are located with the grid of each
+    tile's first granule (L30 and S30 share the MGRS grid, so one file per tile
+    is opened); built-in phenocams are pixels in phenocam_tile. Granules are
+    only listed for tiles holding a site.
+
+    Parameters
+    ----------
+    phenocams : list of site names
+    site_index : optional SiteIndex of registry sites (see hls_sites.py); None
+        uses the built-in pixel table (phenocam_rows_cols)
+    catalog : optional path of an SQLite granule catalog (see hls_catalog.py) to
+        list granules from instead of walking the archive; built if empty
+    refresh : whether to refresh the catalog first
+    start, end : optional (year, doy) of the first and last dates to read
+    sensors : optional list of sensors ('L30', 'S30') to read
+    tiles : optional list of tiles (e.g. 'T13SCS') to read
+    metrics : optional Metrics timing the listing stages
+    root : string the satellite folders are appended to (default image_path_1)
+
+    Attributes
+    ----------
+    phenocams : the sites some tile covers, in the order given
+    outside : the sites no tile covers
+    tile_paths : list of (satellite, year, tile, tile directory) considered
+    tile_rows_cols : dictionary of tile -> dictionary of site -> (row, col)
+    site_tiles : dictionary of site -> sorted list of the tiles covering it
+    tile_rank : dictionary of overlap site -> dictionary of tile -> rank (see drop_overlap_duplicates)
+    granules : list of (satellite, year, doy, granule path) to read, sorted
+    catalog : the catalog path given, or None
+    catalog_changes : (added, updated, removed) if the catalog was refreshed, else None
+    catalog_stale : reasons the catalog may not match the archive if it was not
+        refreshed (see return_stale_reasons), else an empty list
+
+    """
+    def __init__(self,phenocams,site_index=None,catalog=None,refresh=False,start=None,end=None,
+                 sensors=None,tiles=None,metrics=None,root=None):
+        root = image_path_1 if root is None else root
+        site_names = list(phenocam_rows_cols) if site_index is None else list(site_index.registry['name'])
+        unknown = [phenocam for phenocam in phenocams if phenocam not in site_names]
+        if unknown:
+            raise Exception("Unknown site(s): "+', '.join(unknown))
+
+        # Granules to consider: years_L30/years_S30, narrowed by sensors, tiles,
+        # start and end. With a catalog they are queried from the catalog (with
+        # their signatures) instead of listed from the archive.
+        satellites = [satellite for satellite in ('L30','S30') if not sensors or satellite in sensors]
+        years = {satellite:[year for year in years_by_satellite[satellite]
+                            if (not start or year >= start[0]) and (not end or year <= end[0])]
+                 for satellite in satellites}
+        self.catalog = catalog
+        self.catalog_granules = None
+        self.catalog_changes = None
+        self.catalog_stale = []
+        if catalog:
+            with timed(metrics,'catalog'):
+                db = open_catalog(catalog)
+                if refresh or db.execute("SELECT COUNT(*) FROM granules").fetchone()[0] == 0:
+                    self.catalog_changes = refresh_catalog(db, root)
+                else:
+                    self.catalog_stale = return_stale_reasons(db, root)
+                self.catalog_granules = [g for g in query_granules(db, satellites, tiles, start, end) if g[1] in years[g[0]]]
+                db.close()
+            self.tile_paths = sorted({(g[0],g[1],g[3],os.path.dirname(os.path.dirname(g[4]))) for g in self.catalog_granules})
+        else:
+            with timed(metrics,'list_tiles'):
+                self.tile_paths = [tp for satellite in satellites for tp in return_tile_paths(satellite, years[satellite], root)
+                                   if not tiles or tp[2] in tiles]
+
+        self.tile_rows_cols = {}
+        tile_grids = {}
+        for satellite,year,tile,image_path in self.tile_paths:
+            if tile in self.tile_rows_cols:
+                continue
+            if site_index is not None:
+                with timed(metrics,'tile_grid'):
+                    temp_path = return_first_granule(image_path)
+                    if temp_path is None:
+                        continue
+                    tile_grids[tile] = return_tile_grid(temp_path)
+                rows_cols = site_index.sites_in_grid(*tile_grids[tile])
+                self.tile_rows_cols[tile] = {phenocam:rows_cols[phenocam] for phenocam in phenocams if phenocam in rows_cols}
+            elif tile == phenocam_tile:
+                self.tile_rows_cols[tile] = {phenocam:return_phenocam_row_col(phenocam) for phenocam in phenocams}
+            else:
+                self.tile_rows_cols[tile] = {}
+        self.site_tiles = {phenocam:[tile for tile in sorted(self.tile_rows_cols) if phenocam in self.tile_rows_cols[tile]]
+                           for phenocam in phenocams}
+        self.outside = [phenocam for phenocam in phenocams if not self.site_tiles[phenocam]]
+        self.phenocams = [phenocam for phenocam in phenocams if self.site_tiles[phenocam]]
+
+        if self.catalog_granules is not None:
+            self.granules = [g[:3]+(g[4],) for g in self.catalog_granules if self.tile_rows_cols.get(g[3])]
+        else:
+            with timed(metrics,'list_granules'):
+                granules = return_granule_list([tp for tp in self.tile_paths if self.tile_rows_cols.get(tp[2])])
+            self.granules = [g for g in granules if (not start or g[1:3] >= start) and (not end or g[1:3] <= end)]
+
+        # Sites in the overlap of tiles are read from each covering tile. For every
+        # date the row with the most valid pixels is kept; ties go to the tile where
+        # the site is farthest from the edge, then to the first tile name.
+        self.tile_rank = {}
+        for phenocam in self.phenocams:
+            if len(self.site_tiles[phenocam]) > 1:
+                margins = {tile:return_tile_margin(*self.tile_rows_cols[tile][phenocam], *tile_grids[tile][2:])
+                           for tile in self.site_tiles[phenocam]}
+                ranked = sorted(self.site_tiles[phenocam], key=lambda tile: (-margins[tile], tile))
+                self.tile_rank[phenocam] = {tile:rank for rank,tile in enumerate(ranked)}
+
+    def read_tiles(self):
+        """
+        Returns the sorted list of tiles holding at least one site
+        """
+        return sorted(tile for tile in self.tile_rows_cols if self.tile_rows_cols[tile])
+
+    def return_signatures(self,metrics=None):
+        """
+        Returns the (mtime, size) signature of each granule (see
+        return_granule_signature), from the catalog if there is one
+        """
+        if self.catalog_granules is not None:
+            catalog_signatures = {g[4]:(g[5],g[6]) for g in self.catalog_granules}
+            return [catalog_signatures[temp_path] for satellite,year,doy,temp_path in self.granules]
+        with timed(metrics,'signature'):
+            return [return_granule_signature(temp_path) for satellite,year,doy,temp_path in self.granules]
+
+def return_qa_label(qa_policy):
+    """
+    Returns the QAPolicy manifest value of a qa_policy: its conditions sorted and
+    comma-separated, or 'none'
+    """
+    return ','.join(sorted(set(qa_policy))) if qa_policy else 'none'
+
+def return_manifest(granules,signatures,qa_policy=None):
+    """
+    Parameters
+    ----------
+    granules : list of (satellite, year, doy, granule path) tuples
+    signatures : list of the (mtime, size) signature of each granule
+    qa_policy : the QA conditions the granules were read with, see return_granule_windows
+
+    Returns
+    -------
+    manifest : data frame of Granule, Tile, Satellite, Year, DOY, Mtime, Size
+        and QAPolicy (see return_qa_label) of the granules, as written to
+        <phenocam>_manifest.csv
+
+    """
+    import pandas as pd
+    return pd.DataFrame({'Granule':np.array([os.path.basename(g[3]) for g in granules], dtype=object),
+                         'Tile':np.array([return_tile(os.path.basename(g[3])) for g in granules], dtype=object),
+                         'Satellite':np.array([g[0] for g in granules], dtype=object),
+                         'Year':np.array([g[1] for g in granules], dtype=np.int64),
+                         'DOY':np.array([g[2] for g in granules], dtype=np.int64),
+                         'Mtime':np.array([sig[0] for sig in signatures], dtype=np.int64),
+                         'Size':np.array([sig[1] for sig in signatures], dtype=np.int64),
+                         'QAPolicy':np.full(len(granules), return_qa_label(qa_policy), dtype=object)})
+
+def read_granules(granules,tile_rows_cols,workers=1,io_threads=0,prefetch=None,qa_policy=None,profile=False):
+    """
+    Parameters
+    ----------
+    granules : list of (satellite, year, doy, granule path) tuples from return_granule_list
+    tile_rows_cols : dictionary of tile -> dictionary of phenocam name -> (row, col)
+    workers : number of processes reading granules (1 reads them in this process)
+    io_threads : with workers=1, number of threads reading granules ahead of the
+        one being yielded (0 reads each granule when it is needed)
+    prefetch : with io_threads, number of granules read ahead of the one being
+        processed (default 2*io_threads)
+    qa_policy : optional list of QA conditions, see return_granule_windows
+    profile : whether to record stage times and counters (see hls_metrics.py)
+
+    Yields
+    ------
+    granule, windows, metrics : each granule with the output of
+        extract_granule_windows, in the order of granules for any number of
+        workers or threads. Worker processes read at most 2*workers granules
+        ahead, so results waiting for the caller (e.g. a --stream writer) stay
+        bounded.
+
+    """
+    if workers == 1:
+        init_worker(tile_rows_cols, qa_policy, profile)
+        if io_threads:
+            results = prefetch_map(extract_granule_windows, granules, io_threads, prefetch or 2*io_threads)
+        else:
+            results = map(extract_granule_windows, granules)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(tile_rows_cols,qa_policy,profile))
+        results = submit_ahead(pool, extract_granule_windows, granules, 2*workers)
+    try:
+        for granule,(windows,metrics) in zip(granules,results):
+            yield granule,windows,metrics
+    finally:
+        if workers > 1:
+            pool.shutdown(cancel_futures=True)
+
+def add_window_rows(window_rows,granule,windows):
+    """
+    Parameters
+    ----------
+    window_rows : dictionary of phenocam name -> ResultBuilder of window rows
+    granule : (satellite, year, doy, granule path) tuple
+    windows : windows of the granule (see return_granule_windows)
+
+    """
+    satellite,year,doy,temp_path = granule
+    tile = return_tile(os.path.basename(temp_path))
+    for phenocam in windows:
+        temp_data = {'Year':year,
+                     'DOY':doy,
+                     'Satellite':satellite,
+                     'Phenocam':phenocam,
+                     'Tile':tile}
+        temp_data.update(windows[phenocam])
+
+        window_rows[phenocam].add_row(temp_data)
+
+def count_granule_metrics(metrics,windows,granule_metrics):
+    """
+    Merges the stage times and counters recorded while reading a granule into
+    metrics, and counts the granule, its QA-skipped scenes and whether it was all fill
+    """
+    metrics.merge(granule_metrics)
+    metrics.count('granules_read')
+    metrics.count('scenes_qa_skipped', sum(1 for phenocam in windows if windows[phenocam]['SkipReason']))
+    # All -9999: no spectral pixels for any phenocam, and none of them skipped for another QA reason
+    if all(all(windows[phenocam][band] is None for band in window_bands if band != 'Quality') and
+           (not windows[phenocam]['SkipReason'] or 'fill' in windows[phenocam]['SkipReason'].split(';'))
+           for phenocam in windows):
+        metrics.count('granules_all_fill')
+
+def run_extraction(plan,workers=1,io_threads=0,prefetch=None,qa_policy=None,metrics=None,output_dir=None,
+                   window_format=None,parquet=False,incremental=False,checkpoint_every=500,stream=None,
+                   progress=0,dry_run=False,verbose=False):
+    """
+    Reads the granules of a plan and collects, merges and saves each site's
+    rows. extract_sites and the command line (main) both run through it.
+
+    Parameters
+    ----------
+    plan : ExtractionPlan of the sites and granules to read
+    workers, io_threads, prefetch, qa_policy : see read_granules
+    metrics : optional Metrics recording stage times and counters
+    output_dir : optional directory (ending in '/') to write each site's outputs
+        and manifest to; needed by incremental and stream
+    window_format : 'pickle' or 'array', how the windows are stored (default
+        'array' with stream, else 'pickle')
+    parquet : see save_results
+    incremental : whether to only read the granules that are new or changed
+        since the outputs in output_dir were written, and merge their rows in
+    checkpoint_every : with incremental, number of granules between saves of
+        the outputs and manifests, so a crashed run resumes from the last one
+    stream : optional number of rows per site to write at a time (see
+        hls_stream_writer.py), so memory does not grow with the archive
+    progress : seconds between progress lines (0 for none)
+    dry_run : whether to only print the granules that would be read
+    verbose : whether to print the plan, incremental and completion messages
+
+    Returns
+    -------
+    results : dictionary of site name -> (df_window, df_center, df_north), with
+        incremental holding the existing rows as well; empty with stream or
+        dry_run, whose rows are not kept
+
+    """
+    if window_format is None:
+        window_format = 'array' if stream else 'pickle'
+    if (incremental or stream) and output_dir is None:
+        raise Exception("incremental and stream runs need an output_dir")
+    if stream and incremental:
+        raise Exception("stream cannot be combined with incremental")
+    if stream and window_format == 'pickle':
+        raise Exception("stream stores windows as arrays (window_format='array')")
+
+    if verbose:
+        if plan.catalog_changes is not None:
+            added,updated,removed = plan.catalog_changes
+            print("Catalog "+plan.catalog+": "+str(added)+" granules added, "+str(updated)+" changed, "+str(removed)+" removed")
+        for reason in plan.catalog_stale:
+            print("Warning: catalog "+plan.catalog+" may be out of date, "+reason+"; use --refresh-catalog")
+        if plan.outside:
+            print("No imagery covers: "+', '.join(plan.outside))
+        print("Reading "+str(len(plan.read_tiles()))+" of "+str(len({tp[2] for tp in plan.tile_paths}))+" tiles: "+', '.join(plan.read_tiles()))
+    phenocams = plan.phenocams
+    tile_rows_cols = plan.tile_rows_cols
+    site_tiles = plan.site_tiles
+    tile_rank = plan.tile_rank
+    granules = plan.granules
+    signatures = plan.return_signatures(metrics)
+
+    # In incremental mode, skip granules every phenocam already has with the same
+    # mtime/size and QA policy, and keep the existing windows to merge the new
+    # rows into. Rows of granules no longer in the archive or plan are dropped.
+    manifests = dict.fromkeys(phenocams)
+    previous = dict.fromkeys(phenocams)
+    if incremental:
+        keys = ['Satellite','Year','DOY','Tile']
+        listed = {g[:3]+(return_tile(os.path.basename(g[3])),) for g in granules}
+        removed = set()
+        for phenocam in phenocams:
+            with timed(metrics,'read_previous'):
+                manifests[phenocam] = read_manifest(phenocam, window_format, output_dir)
+                if manifests[phenocam] is not None:
+                    previous[phenocam] = read_results(phenocam, window_format, output_dir)
+            if manifests[phenocam] is not None:
+                kept = np.array([key in listed for key in zip(*(manifests[phenocam][key] for key in keys))], dtype=bool)
+                removed.update(key[:3]+(phenocam,) for key in zip(*(manifests[phenocam][~kept][key] for key in keys)))
+                manifests[phenocam] = manifests[phenocam][kept].reset_index(drop=True)
+                kept = np.array([key in listed for key in zip(*(previous[phenocam][key] for key in keys))], dtype=bool)
+                previous[phenocam] = previous[phenocam][kept].reset_index(drop=True)
+        # Manifests written before the QAPolicy column never match, so their
+        # granules are all read again
+        qa_label = return_qa_label(qa_policy)
+        done = {phenocam:set() if manifests[phenocam] is None or 'QAPolicy' not in manifests[phenocam] else
+                set(zip(manifests[phenocam]['Granule'],manifests[phenocam]['Mtime'],manifests[phenocam]['Size'],
+                        manifests[phenocam]['QAPolicy']))
+                for phenocam in phenocams}
+        todo = {i for i,g in enumerate(granules)
+                if any((os.path.basename(g[3]),)+signatures[i]+(qa_label,) not in done[phenocam]
+                       for phenocam in tile_rows_cols[return_tile(os.path.basename(g[3]))])}
+        # A date read again for an overlap site, or whose row came from a removed
+        # granule, is read again from all its tiles, so the duplicate is resolved
+        # as in a full run
+        redo = {g[:3]+(phenocam,) for i,g in enumerate(granules) if i in todo
+                for phenocam in tile_rows_cols[return_tile(os.path.basename(g[3]))] if phenocam in tile_rank}
+        redo.update(key for key in removed if key[3] in tile_rank)
+        todo = [i for i,g in enumerate(granules) if i in todo or
+                any(g[:3]+(phenocam,) in redo for phenocam in tile_rows_cols[return_tile(os.path.basename(g[3]))])]
+        if verbose:
+            print(str(len(todo))+" of "+str(len(granules))+" granules are new or changed")
+        granules = [granules[i] for i in todo]
+        signatures = [signatures[i] for i in todo]
+
+    if dry_run:
+        for satellite,year,doy,temp_path in granules:
+            print(temp_path)
+        return {}
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    def save_checkpoint(n_done):
+        """
+        Returns every phenocam's outputs for the first n_done granules, merged
+        with the previous ones, and saves them and their manifests to output_dir
+        """
+        manifest_new = return_manifest(granules[:n_done], signatures[:n_done], qa_policy) if output_dir is not None else None
+        results = {}
+        for phenocam in phenocams:
+            with timed(metrics,'merge'):
+                df_window = window_rows[phenocam].to_frame()
+                if phenocam in tile_rank:
+                    df_window = drop_overlap_duplicates(df_window, tile_rank[phenocam])
+                if previous[phenocam] is not None:
+                    df_window = merge_results(previous[phenocam], df_window)
+            with timed(metrics,'stats'):
+                df_center,df_north = return_center_north_frames(df_window)
+            results[phenocam] = (df_window,df_center,df_north)
+            if output_dir is not None:
+                with timed(metrics,'merge'):
+                    manifest = manifest_new[manifest_new['Tile'].isin(site_tiles[phenocam])]
+                    if manifests[phenocam] is not None:
+                        manifest = merge_results(manifests[phenocam], manifest, keys=('Satellite','Year','DOY','Tile'))
+                with timed(metrics,'output'):
+                    save_results(phenocam, df_window, df_center, df_north, manifest, window_format, parquet, output_dir)
+        return results
+
+    # One window row per granule for each phenocam. The center/north statistics
+    # are computed from the stacked windows when the outputs are saved.
+    window_rows = {phenocam:ResultBuilder(window_columns, stream or len(granules), window_dtypes) for phenocam in phenocams}
+
+    # With stream, rows are written every stream rows. Rows of the last date of
+    # a chunk are held back for overlap sites, so all tiles' rows of a date are
+    # in the same chunk when duplicates are dropped.
+    writers = {phenocam:StreamWriter(output_dir+phenocam) for phenocam in phenocams} if stream else {}
+
+    def write_chunk(phenocam,final=False):
+        """Appends a phenocam's window rows so far to its streamed outputs"""
+        with timed(metrics,'merge'):
+            df_window = window_rows[phenocam].to_frame()
+            window_rows[phenocam].reset()
+            if phenocam in tile_rank:
+                if not final:
+                    keys = ['Satellite','Year','DOY']
+                    held = (df_window[keys] == df_window[keys].iloc[-1]).all(axis=1)
+                    for row in df_window[held].to_dict('records'):
+                        window_rows[phenocam].add_row(row)
+                    df_window = df_window[~held].reset_index(drop=True)
+                df_window = drop_overlap_duplicates(df_window, tile_rank[phenocam])
+        with timed(metrics,'stats'):
+            df_center,df_north = return_center_north_frames(df_window)
+        with timed(metrics,'output'):
+            writers[phenocam].append_windows(df_window)
+            writers[phenocam].append_csv('_center.csv', df_center)
+            writers[phenocam].append_csv('_north.csv', df_north)
+            if parquet:
+                writers[phenocam].append_parquet('_center.parquet', return_analysis_frame(df_center))
+                writers[phenocam].append_parquet('_north.parquet', return_analysis_frame(df_north))
+
+    # Granules come back in order, so rows come out sorted by Satellite/Year/DOY
+    # for any number of workers or threads
+    granule_windows = read_granules(granules, tile_rows_cols, workers, io_threads, prefetch,
+                                    qa_policy, metrics is not None)
+
+    progress_meter = Progress(len(granules), progress) if progress else None
+    for n,(granule,windows,granule_metrics) in enumerate(granule_windows):
+        with timed(metrics,'collect'):
+            add_window_rows(window_rows, granule, windows)
+        if metrics is not None:
+            count_granule_metrics(metrics, windows, granule_metrics)
+        if progress_meter is not None:
+            progress_meter.update(n+1)
+
+        for phenocam in writers:
+            if window_rows[phenocam].n >= stream:
+                write_chunk(phenocam)
+
+        if incremental and (n+1) % checkpoint_every == 0 and n+1 < len(granules):
+            save_checkpoint(n+1)
+            if verbose:
+                print("checkpoint: "+str(n+1)+" of "+str(len(granules))+" granules")
+
+    """
+    Save results
+    """
+    results = {}
+    if stream:
+        manifest_new = return_manifest(granules, signatures, qa_policy)
+        for phenocam in phenocams:
+            write_chunk(phenocam, final=True)
+            writers[phenocam].finalize()
+            manifest = manifest_new[manifest_new['Tile'].isin(site_tiles[phenocam])]
+            manifest.to_csv(output_dir+phenocam+'_manifest.csv.tmp', index=False)
+            os.replace(output_dir+phenocam+'_manifest.csv.tmp', output_dir+phenocam+'_manifest.csv')
+    else:
+        results = save_checkpoint(len(granules))
+    if verbose:
+        for phenocam in phenocams:
+            print(phenocam+" complete!")
+    return results
+
+def extract_sites(phenocams=None,site_index=None,catalog=None,start=None,end=None,sensors=None,tiles=None,
+                  workers=1,io_threads=0,prefetch=None,qa_policy=None,metrics=None,root=None,output_dir=None,
+                  window_format=None,parquet=False,incremental=False,checkpoint_every=500,stream=None):
+    """
+    Extracts the windows and center/north statistics of a set of sites, for use
+    from other code; files are only written if output_dir is given. A
+    long-lived process can call it for many groups of sites, paying for the
+    rasterio/GDAL set-up once.
+
+    Parameters
+    ----------
+    phenocams : list of site names, None for every site (the built-in phenocams,
+        or every site in site_index)
+    site_index : optional SiteIndex of registry sites, e.g.
+        SiteIndex(read_site_registry('sites.csv')); None uses phenocam_rows_cols
+    catalog, start, end, sensors, tiles : see ExtractionPlan
+    workers, io_threads, prefetch, qa_policy : see read_granules
+    metrics : optional Metrics recording stage times and counters
+    root : string the satellite folders are appended to (default image_path_1)
+    output_dir : optional directory (ending in '/') to also write each site's
+        outputs and manifest to, as import_HLS_pixel_data.py does
+    window_format, parquet, incremental, checkpoint_every, stream : with
+        output_dir, see run_extraction
+
+    Returns
+    -------
+    results : dictionary of site name -> (df_window, df_center, df_north), the
+        data frames import_HLS_pixel_data.py writes; sites no tile covers are
+        left out, and with stream the rows are only written
+
+    """
+    if phenocams is None:
+        phenocams = list(phenocam_rows_cols) if site_index is None else list(site_index.registry['name'])
+    plan = ExtractionPlan(phenocams, site_index, catalog, False, start, end, sensors, tiles, metrics, root)
+    return run_extraction(plan, workers, io_threads, prefetch, qa_policy, metrics, output_dir,
+                          window_format, parquet, incremental, checkpoint_every, stream)
+
 """
 Paths and Variables
 """
 image_path_1 = 'path_to_hls_imagery' # File location of L30 and S30 folders created by HLS bulk download
-image_path_2 = '/13/S/C/S'
-phenocam = args.phen_name
-row,col = return_phenocam_row_col(phenocam)
+image_path_2 = None # Tile directory to read, e.g. '/13/S/C/S'; None finds every tile in the download and reads the ones holding sites
 years_L30 = [2014,2015,2016,2017,2018,2019,2020,2021,2022]
 years_S30 = [2016,2017,2018,2019,2020,2021,2022]
 output_dir = 'data/outputs_hls/'
 
+# Band file suffix for each band, by sensor. Bands missing from a sensor are left as None.
+bands_L30 = {'CoastalAerosol':'B01',
+             'Blue':'B02',
+             'Green':'B03',
+             'Red':'B04',
+             'NIRNarrow':'B05',
+             'SWIR1':'B06',
+             'SWIR2':'B07',
+             'Cirrus':'B09',
+             'TIR1':'B10',
+             'TIR2':'B11',
+             'Quality':'Fmask'}
+bands_S30 = {'CoastalAerosol':'B01',
+             'Blue':'B02',
+             'Green':'B03',
+             'Red':'B04',
+             'RedEdge1':'B05',
+             'RedEdge2':'B06',
+             'RedEdge3':'B07',
+             'NIRBroad':'B08',
+             'NIRNarrow':'B8A',
+             'SWIR1':'B11',
+             'SWIR2':'B12',
+             'WaterVapor':'B09',
+             'Cirrus':'B10',
+             'Quality':'Fmask'}
+bands_by_satellite = {'L30':bands_L30, 'S30':bands_S30}
+years_by_satellite = {'L30':years_L30, 'S30':years_S30}
+
+# GDAL settings for the long-lived environment in each process. Band files sit
+# alone in their granule directory, so skip the directory scan for sidecar files.
+gdal_options = {'GDAL_DISABLE_READDIR_ON_OPEN':'EMPTY_DIR'}
+io_thread_state = threading.local()
+
+# Stage times and counters of this process, set by init_worker with profile=True,
+# and the GDAL environment init_worker enters once per process
+worker_metrics = None
+worker_env = None
+
 """
-Initialize data frames
+Output columns
 """
-empty_data_frame_window = pd.DataFrame(columns=('Year',
-                                                'DOY',
-                                                'Satellite',
-                                                'Phenocam',
-                                                'CoastalAerosol',
-                                                'Blue',
-                                                'Green',
-                                                'Red',
-                                                'RedEdge1',
-                                                'RedEdge2',
-                                                'RedEdge3',
-                                                'NIRBroad',
-                                                'NIRNarrow',
-                                                'SWIR1',
-                                                'SWIR2',
-                                                'WaterVapor',
-                                                'Cirrus',
-                                                'TIR1',
-                                                'TIR2',
-                                                'Quality'))
-
-empty_data_frame_meanstd = pd.DataFrame(columns=('Year',
-                                                 'DOY',
-                                                 'Satellite',
-                                                 'Phenocam',
-                                                 'CenterOrNorth',
-                                                 'CoastalAerosol_mean',
-                                                 'CoastalAerosol_std',
-                                                 'Blue_mean',
-                                                 'Blue_std',
-                                                 'Green_mean',
-                                                 'Green_std',
-                                                 'Red_mean',
-                                                 'Red_std',
-                                                 'RedEdge1_mean',
-                                                 'RedEdge1_std',
-                                                 'RedEdge2_mean',
-                                                 'RedEdge2_std',
-                                                 'RedEdge3_mean',
-                                                 'RedEdge3_std',
-                                                 'NIRBroad_mean',
-                                                 'NIRBroad_std',
-                                                 'NIRNarrow_mean',
-                                                 'NIRNarrow_std',
-                                                 'SWIR1_mean',
-                                                 'SWIR1_std',
-                                                 'SWIR2_mean',
-                                                 'SWIR2_std',
-                                                 'WaterVapor_mean',
-                                                 'WaterVapor_std',
-                                                 'Cirrus_mean',
-                                                 'Cirrus_std',
-                                                 'Quality'))
+window_columns = ('Year',
+                  'DOY',
+                  'Satellite',
+                  'Phenocam',
+                  'CoastalAerosol',
+                  'Blue',
+                  'Green',
+                  'Red',
+                  'RedEdge1',
+                  'RedEdge2',
+                  'RedEdge3',
+                  'NIRBroad',
+                  'NIRNarrow',
+                  'SWIR1',
+                  'SWIR2',
+                  'WaterVapor',
+                  'Cirrus',
+                  'TIR1',
+                  'TIR2',
+                  'Quality',
+                  'SkipReason',
+                  'Tile')
+
+meanstd_columns = ('Year',
+                   'DOY',
+                   'Satellite',
+                   'Phenocam',
+                   'CenterOrNorth',
+                   'CoastalAerosol_mean',
+                   'CoastalAerosol_std',
+                   'CoastalAerosol_count',
+                   'Blue_mean',
+                   'Blue_std',
+                   'Blue_count',
+                   'Green_mean',
+                   'Green_std',
+                   'Green_count',
+                   'Red_mean',
+                   'Red_std',
+                   'Red_count',
+                   'RedEdge1_mean',
+                   'RedEdge1_std',
+                   'RedEdge1_count',
+                   'RedEdge2_mean',
+                   'RedEdge2_std',
+                   'RedEdge2_count',
+                   'RedEdge3_mean',
+                   'RedEdge3_std',
+                   'RedEdge3_count',
+                   'NIRBroad_mean',
+                   'NIRBroad_std',
+                   'NIRBroad_count',
+                   'NIRNarrow_mean',
+                   'NIRNarrow_std',
+                   'NIRNarrow_count',
+                   'SWIR1_mean',
+                   'SWIR1_std',
+                   'SWIR1_count',
+                   'SWIR2_mean',
+                   'SWIR2_std',
+                   'SWIR2_count',
+                   'WaterVapor_mean',
+                   'WaterVapor_std',
+                   'WaterVapor_count',
+                   'Cirrus_mean',
+                   'Cirrus_std',
+                   'Quality',
+                   'SkipReason')
+
+# Bands that get mean/std columns (Cirrus has columns in the mean/std frames
+# but is not filled in). The window band columns are window_bands.
+meanstd_band_names = ['CoastalAerosol','Blue','Green','Red','RedEdge1','RedEdge2','RedEdge3',
+                      'NIRBroad','NIRNarrow','SWIR1','SWIR2','WaterVapor']
+
+# Column types for the window result builder; columns not listed hold Python
+# objects (strings, and the window arrays or None)
+window_dtypes = {'Year':np.int64, 'DOY':np.int64}
 
 """
 Extract band info and save it in pandas dataframe
 """
-df_window = empty_data_frame_window
-df_center = empty_data_frame_meanstd
-df_north = empty_data_frame_meanstd
-
-satellite = 'L30'
-for y in years_L30:
-    year = y
-    image_path = create_image_path(image_path_1, image_path_2, satellite, year)
-    image_list = os.listdir(image_path)
-    
-    #for i in range(3):
-    for i in image_list:
-        im_name = i
-        year,doy = return_year_doy(im_name)
-        temp_path = image_path+'/'+im_name+'/'+im_name
-        
-        coastalaerosol = return_phenocam_pixels(row, col, temp_path+'.B01.tif')
-        blue = return_phenocam_pixels(row, col, temp_path+'.B02.tif')
-        green = return_phenocam_pixels(row, col, temp_path+'.B03.tif')
-        red = return_phenocam_pixels(row, col, temp_path+'.B04.tif')
-        rededge1 = None
-        rededge2 = None
-        rededge3 = None
-        nirbroad = None
-        nirnarrow = return_phenocam_pixels(row, col, temp_path+'.B05.tif')
-        swir1 = return_phenocam_pixels(row, col, temp_path+'.B06.tif')
-        swir2 = return_phenocam_pixels(row, col, temp_path+'.B07.tif')
-        watervapor = None
-        cirrus = return_phenocam_pixels(row, col, temp_path+'.B09.tif')
-        tir1 = return_phenocam_pixels(row, col, temp_path+'.B10.tif')
-        tir2 = return_phenocam_pixels(row, col, temp_path+'.B11.tif')
-        quality = return_phenocam_pixels(row, col, temp_path+'.Fmask.tif')
-        temp_data = {'Year':year,
-                     'DOY':doy,
-                     'Satellite':satellite,
-                     'Phenocam':phenocam,
-                     'CoastalAerosol':coastalaerosol,
-                     'Blue':blue,
-                     'Green':green,
-                     'Red':red,
-                     'RedEdge1':rededge1,
-                     'RedEdge2':rededge2,
-                     'RedEdge3':rededge3,
-                     'NIRBroad':nirbroad,
-                     'NIRNarrow':nirnarrow,
-                     'SWIR1':swir1,
-                     'SWIR2':swir2,
-                     'WaterVapor':watervapor,
-                     'Cirrus':cirrus,
-                     'TIR1':tir1,
-                     'TIR2':tir2,
-                     'Quality':quality}
-        
-        df_window = pd.concat([df_window,pd.DataFrame.from_dict([temp_data])],ignore_index=True)
-        
-        ca_mean_north,ca_mean_center,ca_std_north,ca_std_center = return_mean_std(coastalaerosol)
-        b_mean_north,b_mean_center,b_std_north,b_std_center = return_mean_std(blue)
-        g_mean_north,g_mean_center,g_std_north,g_std_center = return_mean_std(green)
-        r_mean_north,r_mean_center,r_std_north,r_std_center = return_mean_std(red)
-        re1_mean_north,re1_mean_center,re1_std_north,re1_std_center = return_mean_std(rededge1)
-        re2_mean_north,re2_mean_center,re2_std_north,re2_std_center = return_mean_std(rededge2)
-        re3_mean_north,re3_mean_center,re3_std_north,re3_std_center = return_mean_std(rededge3)
-        n_b_mean_north,n_b_mean_center,n_b_std_north,n_b_std_center = return_mean_std(nirbroad)
-        n_n_mean_north,n_n_mean_center,n_n_std_north,n_n_std_center = return_mean_std(nirnarrow)
-        sw1_mean_north,sw1_mean_center,sw1_std_north,sw1_std_center = return_mean_std(swir1)
-        sw2_mean_north,sw2_mean_center,sw2_std_north,sw2_std_center = return_mean_std(swir2)
-        wv_mean_north,wv_mean_center,wv_std_north,wv_std_center = return_mean_std(watervapor)
-        cir_mean_north,cir_mean_center,cir_std_north,cir_std_center = return_mean_std(cirrus)
-        qa_center = np.ndarray.flatten(quality); qa_center = qa_center[7]
-        
-        temp_data = {'Year':year,
-                     'DOY':doy,
-                     'Satellite':satellite,
-                     'Phenocam':phenocam,
-                     'CenterOrNorth':'north',
-                     'CoastalAerosol_mean':ca_mean_north,
-                     'CoastalAerosol_std':ca_std_north,
-                     'Blue_mean':b_mean_north,
-                     'Blue_std':b_std_north,
-                     'Green_mean':g_mean_north,
-                     'Green_std':g_std_north,
-                     'Red_mean':r_mean_north,
-                     'Red_std':r_std_north,
-                     'RedEdge1_mean':re1_mean_north,
-                     'RedEdge1_std':re1_std_north,
-                     'RedEdge2_mean':re2_mean_north,
-                     'RedEdge2_std':re2_std_north,
-                     'RedEdge3_mean':re3_mean_north,
-                     'RedEdge3_std':re3_std_north,
-                     'NIRBroad_mean':n_b_mean_north,
-                     'NIRBroad_std':n_b_std_north,
-                     'NIRNarrow_mean':n_n_mean_north,
-                     'NIRNarrow_std':n_n_std_north,
-                     'SWIR1_mean':sw1_mean_north,
-                     'SWIR1_std':sw1_std_north,
-                     'SWIR2_mean':sw2_mean_north,
-                     'SWIR2_std':sw2_std_north,
-                     'WaterVapor_mean':wv_mean_north,
-                     'WaterVapor_std':wv_std_north,
-                     'Quality':qa_center}
-        
-        df_north = pd.concat([df_north,pd.DataFrame.from_dict([temp_data])],ignore_index=True)
-        
-        temp_data = {'Year':year,
-                     'DOY':doy,
-                     'Satellite':satellite,
-                     'Phenocam':phenocam,
-                     'CenterOrNorth':'center',
-                     'CoastalAerosol_mean':ca_mean_center,
-                     'CoastalAerosol_std':ca_std_center,
-                     'Blue_mean':b_mean_center,
-                     'Blue_std':b_std_center,
-                     'Green_mean':g_mean_center,
-                     'Green_std':g_std_center,
-                     'Red_mean':r_mean_center,
-                     'Red_std':r_std_center,
-                     'RedEdge1_mean':re1_mean_center,
-                     'RedEdge1_std':re1_std_center,
-                     'RedEdge2_mean':re2_mean_center,
-                     'RedEdge2_std':re2_std_center,
-                     'RedEdge3_mean':re3_mean_center,
-                     'RedEdge3_std':re3_std_center,
-                     'NIRBroad_mean':n_b_mean_center,
-                     'NIRBroad_std':n_b_std_center,
-                     'NIRNarrow_mean':n_n_mean_center,
-                     'NIRNarrow_std':n_n_std_center,
-                     'SWIR1_mean':sw1_mean_center,
-                     'SWIR1_std':sw1_std_center,
-                     'SWIR2_mean':sw2_mean_center,
-                     'SWIR2_std':sw2_std_center,
-                     'WaterVapor_mean':wv_mean_center,
-                     'WaterVapor_std':wv_std_center,
-                     'Quality':qa_center}
-        
-        df_center = pd.concat([df_center,pd.DataFrame.from_dict([temp_data])],ignore_index=True)
-
-satellite = 'S30'
-for y in years_S30:
-    year = y
-    image_path = create_image_path(image_path_1, image_path_2, satellite, year)
-    image_list = os.listdir(image_path)
-    
-    #for i in range(3):
-    for i in image_list:
-        im_name = i
-        year,doy = return_year_doy(im_name)
-        temp_path = image_path+'/'+im_name+'/'+im_name        
-        coastalaerosol = return_phenocam_pixels(row, col, temp_path+'.B01.tif')
-        blue = return_phenocam_pixels(row, col, temp_path+'.B02.tif')
-        green = return_phenocam_pixels(row, col, temp_path+'.B03.tif')
-        red = return_phenocam_pixels(row, col, temp_path+'.B04.tif')
-        rededge1 = return_phenocam_pixels(row, col, temp_path+'.B05.tif')
-        rededge2 = return_phenocam_pixels(row, col, temp_path+'.B06.tif')
-        rededge3 = return_phenocam_pixels(row, col, temp_path+'.B07.tif')
-        nirbroad = return_phenocam_pixels(row, col, temp_path+'.B08.tif')
-        nirnarrow = return_phenocam_pixels(row, col, temp_path+'.B8A.tif')
-        swir1 = return_phenocam_pixels(row, col, temp_path+'.B11.tif')
-        swir2 = return_phenocam_pixels(row, col, temp_path+'.B12.tif')
-        watervapor = return_phenocam_pixels(row, col, temp_path+'.B09.tif')
-        cirrus = return_phenocam_pixels(row, col, temp_path+'.B10.tif')
-        tir1 = None
-        tir2 = None
-        quality = return_phenocam_pixels(row, col, temp_path+'.Fmask.tif')
-        temp_data = {'Year':year,
-                     'DOY':doy,
-                     'Satellite':satellite,
-                     'Phenocam':phenocam,
-                     'CoastalAerosol':coastalaerosol,
-                     'Blue':blue,
-                     'Green':green,
-                     'Red':red,
-                     'RedEdge1':rededge1,
-                     'RedEdge2':rededge2,
-                     'RedEdge3':rededge3,
-                     'NIRBroad':nirbroad,
-                     'NIRNarrow':nirnarrow,
-                     'SWIR1':swir1,
-                     'SWIR2':swir2,
-                     'WaterVapor':watervapor,
-                     'Cirrus':cirrus,
-                     'TIR1':tir1,
-                     'TIR2':tir2,
-                     'Quality':quality}
-        
-        df_window = pd.concat([df_window,pd.DataFrame.from_dict([temp_data])],ignore_index=True)
-        
-        ca_mean_north,ca_mean_center,ca_std_north,ca_std_center = return_mean_std(coastalaerosol)
-        b_mean_north,b_mean_center,b_std_north,b_std_center = return_mean_std(blue)
-        g_mean_north,g_mean_center,g_std_north,g_std_center = return_mean_std(green)
-        r_mean_north,r_mean_center,r_std_north,r_std_center = return_mean_std(red)
-        re1_mean_north,re1_mean_center,re1_std_north,re1_std_center = return_mean_std(rededge1)
-        re2_mean_north,re2_mean_center,re2_std_north,re2_std_center = return_mean_std(rededge2)
-        re3_mean_north,re3_mean_center,re3_std_north,re3_std_center = return_mean_std(rededge3)
-        n_b_mean_north,n_b_mean_center,n_b_std_north,n_b_std_center = return_mean_std(nirbroad)
-        n_n_mean_north,n_n_mean_center,n_n_std_north,n_n_std_center = return_mean_std(nirnarrow)
-        sw1_mean_north,sw1_mean_center,sw1_std_north,sw1_std_center = return_mean_std(swir1)
-        sw2_mean_north,sw2_mean_center,sw2_std_north,sw2_std_center = return_mean_std(swir2)
-        wv_mean_north,wv_mean_center,wv_std_north,wv_std_center = return_mean_std(watervapor)
-        cir_mean_north,cir_mean_center,cir_std_north,cir_std_center = return_mean_std(cirrus)
-        qa_center = np.ndarray.flatten(quality); qa_center = qa_center[7]
-        
-        temp_data = {'Year':year,
-                     'DOY':doy,
-                     'Satellite':satellite,
-                     'Phenocam':phenocam,
-                     'CenterOrNorth':'north',
-                     'CoastalAerosol_mean':ca_mean_north,
-                     'CoastalAerosol_std':ca_std_north,
-                     'Blue_mean':b_mean_north,
-                     'Blue_std':b_std_north,
-                     'Green_mean':g_mean_north,
-                     'Green_std':g_std_north,
-                     'Red_mean':r_mean_north,
-                     'Red_std':r_std_north,
-                     'RedEdge1_mean':re1_mean_north,
-                     'RedEdge1_std':re1_std_north,
-                     'RedEdge2_mean':re2_mean_north,
-                     'RedEdge2_std':re2_std_north,
-                     'RedEdge3_mean':re3_mean_north,
-                     'RedEdge3_std':re3_std_north,
-                     'NIRBroad_mean':n_b_mean_north,
-                     'NIRBroad_std':n_b_std_north,
-                     'NIRNarrow_mean':n_n_mean_north,
-                     'NIRNarrow_std':n_n_std_north,
-                     'SWIR1_mean':sw1_mean_north,
-                     'SWIR1_std':sw1_std_north,
-                     'SWIR2_mean':sw2_mean_north,
-                     'SWIR2_std':sw2_std_north,
-                     'WaterVapor_mean':wv_mean_north,
-                     'WaterVapor_std':wv_std_north,
-                     'Quality':qa_center}
-        
-        df_north = pd.concat([df_north,pd.DataFrame.from_dict([temp_data])],ignore_index=True)
-        
-        temp_data = {'Year':year,
-                     'DOY':doy,
-                     'Satellite':satellite,
-                     'Phenocam':phenocam,
-                     'CenterOrNorth':'center',
-                     'CoastalAerosol_mean':ca_mean_center,
-                     'CoastalAerosol_std':ca_std_center,
-                     'Blue_mean':b_mean_center,
-                     'Blue_std':b_std_center,
-                     'Green_mean':g_mean_center,
-                     'Green_std':g_std_center,
-                     'Red_mean':r_mean_center,
-                     'Red_std':r_std_center,
-                     'RedEdge1_mean':re1_mean_center,
-                     'RedEdge1_std':re1_std_center,
-                     'RedEdge2_mean':re2_mean_center,
-                     'RedEdge2_std':re2_std_center,
-                     'RedEdge3_mean':re3_mean_center,
-                     'RedEdge3_std':re3_std_center,
-                     'NIRBroad_mean':n_b_mean_center,
-                     'NIRBroad_std':n_b_std_center,
-                     'NIRNarrow_mean':n_n_mean_center,
-                     'NIRNarrow_std':n_n_std_center,
-                     'SWIR1_mean':sw1_mean_center,
-                     'SWIR1_std':sw1_std_center,
-                     'SWIR2_mean':sw2_mean_center,
-                     'SWIR2_std':sw2_std_center,
-                     'WaterVapor_mean':wv_mean_center,
-                     'WaterVapor_std':wv_std_center,
-                     'Quality':qa_center}
-        
-        df_center = pd.concat([df_center,pd.DataFrame.from_dict([temp_data])],ignore_index=True)
-
-df_north = df_north.astype({"Quality":np.uint8})
-df_center = df_center.astype({"Quality":np.uint8})
+def main(argv=None):
+    """
+    Command line entry point: extracts the sites named in argv (default
+    sys.argv[1:], see parser) and writes their outputs to output_dir
+    """
+    run_start = time.perf_counter()
+    args = parser.parse_args(argv)
+    site_index = None
+    if args.sites:
+        site_index = SiteIndex(read_site_registry(args.sites))
+        site_names = list(site_index.registry['name'])
+    else:
+        site_names = list(phenocam_rows_cols)
+    if args.all:
+        phenocams = site_names
+    elif args.phen_name:
+        phenocams = list(dict.fromkeys(args.phen_name))
+        unknown = [phenocam for phenocam in phenocams if phenocam not in site_names]
+        if unknown:
+            parser.error("unknown site(s): "+', '.join(unknown))
+    else:
+        parser.error("give at least one phenocam name, or --all")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.io_threads < 0:
+        parser.error("--io-threads must be at least 0")
+    if args.io_threads and args.workers > 1:
+        parser.error("--io-threads only works with --workers 1")
+    if args.prefetch is None:
+        args.prefetch = 2*args.io_threads
+    elif args.prefetch < 1:
+        parser.error("--prefetch must be at least 1")
+    if args.checkpoint_every < 1:
+        parser.error("--checkpoint-every must be at least 1")
+    qa_policy = None
+    if args.qa_skip:
+        qa_policy = args.qa_skip.split(',')
+        unknown = [name for name in qa_policy if name not in ['fill','aerosol_high']+list(qa_bits)]
+        if unknown:
+            parser.error("unknown --qa-skip condition(s): "+', '.join(unknown))
+    try:
+        args.start = return_date_year_doy(args.start) if args.start else None
+        args.end = return_date_year_doy(args.end) if args.end else None
+    except ValueError:
+        parser.error("--start and --end must be dates as YYYY-MM-DD or YYYYDDD")
+    if args.stream is not None:
+        if args.stream < 1:
+            parser.error("--stream must be at least 1 row")
+        if args.incremental:
+            parser.error("--stream cannot be combined with --incremental")
+        if args.window_format == 'pickle':
+            parser.error("--stream stores windows as arrays (--window-format array)")
+        args.window_format = 'array'
+    elif args.window_format is None:
+        args.window_format = 'pickle'
+    if args.progress < 0:
+        parser.error("--progress must be at least 0")
+    run_metrics = Metrics() if args.profile or args.metrics_out else None
+    if args.parquet:
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("--parquet needs the pyarrow package (pip install pyarrow)")
 
-"""
-Save results
-"""
-window_filename = output_dir+phenocam+'_window.pkl'
-center_filename = output_dir+phenocam+'_center.csv'
-north_filename = output_dir+phenocam+'_north.csv'
+    plan = ExtractionPlan(phenocams, site_index, args.catalog, args.refresh_catalog,
+                          args.start, args.end, args.sensors, args.tiles, run_metrics, args.root)
+    run_extraction(plan, args.workers, args.io_threads, args.prefetch, qa_policy, run_metrics, output_dir,
+                   args.window_format, args.parquet, args.incremental, args.checkpoint_every, args.stream,
+                   args.progress, args.dry_run, verbose=True)
 
-df_window.to_pickle(window_filename)
-df_center.to_csv(center_filename)
-df_north.to_csv(north_filename)
+    if run_metrics is not None and not args.dry_run:
+        run_metrics.count('granules_listed', len(plan.granules))
+        wall_seconds = time.perf_counter()-run_start
+        run_metrics.print_summary(wall_seconds)
+        if args.metrics_out:
+            run_metrics.write_json(args.metrics_out, wall_seconds, {'arguments':vars(args), 'phenocams':plan.phenocams})
 
-print(phenocam+" complete!")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
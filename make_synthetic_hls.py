@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Writes a synthetic HLS v2.0 archive for testing and benchmarking
+import_HLS_pixel_data.py without the real bulk download.
+
+The tree has the layout the import script expects,
+    <root>L30/<year>/13/S/C/S/HLS.L30.T13SCS.<year><doy>T173000.v2.0/HLS.L30.T13SCS.<year><doy>T173000.v2.0.<band>.tif
+(and the same for S30), with one tiled, deflate-compressed GeoTIFF per band
+and an Fmask band, on the T13SCS grid (3660x3660 pixels of 30 m, EPSG:32613).
+Only the internal blocks around the built-in phenocam pixels are written
+(the rest of each file is sparse and reads as nodata), so the archive is
+small and quick to write. A --fill-fraction of the granules are all fill,
+and a --cloud-fraction of the phenocam pixels have the Fmask cloud bit set.
+
+Example (from the directory the import script is run in):
+    python make_synthetic_hls.py path_to_hls_imagery --granules 20
+"""
+
+# Imports
+import argparse
+import os
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from import_HLS_pixel_data import bands_by_satellite, phenocam_rows_cols, phenocam_tile, qa_bits
+
+# Grid of the synthetic tile
+tile_dir = '/13/S/C/S'
+tile_crs = 'EPSG:32613'
+tile_transform = from_origin(300000, 3600000, 30, 30)
+tile_size = 3660
+block_size = 256
+
+# Functions
+def return_granule_name(satellite,year,doy):
+    """
+    Returns the HLS granule name for a satellite, year and DOY, e.g.
+    'HLS.L30.T13SCS.2021010T173000.v2.0'
+    """
+    return 'HLS.'+satellite+'.'+phenocam_tile+'.'+str(year)+str(doy).zfill(3)+'T173000.v2.0'
+
+def return_site_blocks():
+    """
+    Returns the sorted list of (block row, block col) of the internal blocks
+    holding a built-in phenocam window
+    """
+    blocks = set()
+    for row,col in phenocam_rows_cols.values():
+        for r in range(row-2, row+2):
+            for c in range(col-1, col+2):
+                blocks.add((r//block_size, c//block_size))
+    return sorted(blocks)
+
+def write_band(filename,blocks,fill,quality,cloud_fraction,rng):
+    """
+    Parameters
+    ----------
+    filename : string containing the path of the band file
+    blocks : list of (block row, block col) to write
+    fill : whether the granule is all fill
+    quality : whether the band is Fmask (uint8) rather than reflectance (int16)
+    cloud_fraction : fraction of Fmask pixels with the cloud bit set
+    rng : numpy random generator
+
+    """
+    dtype = np.uint8 if quality else np.int16
+    nodata = 255 if quality else -9999
+    with rasterio.open(filename, 'w', driver='GTiff', width=tile_size, height=tile_size, count=1,
+                       dtype=dtype, crs=tile_crs, transform=tile_transform, nodata=nodata,
+                       tiled=True, blockxsize=block_size, blockysize=block_size,
+                       compress='deflate', sparse_ok=True) as dst:
+        if fill:
+            return
+        for r,c in blocks:
+            height = min(block_size, tile_size-r*block_size)
+            width = min(block_size, tile_size-c*block_size)
+            if quality:
+                data = np.where(rng.random((height,width)) < cloud_fraction, 1 << qa_bits['cloud'], 64).astype(dtype)
+            else:
+                data = rng.integers(0, 5000, size=(height,width), dtype=dtype)
+            dst.write(data, 1, window=Window(c*block_size, r*block_size, width, height))
+
+def make_archive(root,granules,years_L30=(2021,),years_S30=(2021,),fill_fraction=0.1,cloud_fraction=0.2,seed=0):
+    """
+    Parameters
+    ----------
+    root : string the satellite folders are appended to (image_path_1 of the import script)
+    granules : number of granules per satellite and year, spread evenly over the year
+    years_L30, years_S30 : years to write for each satellite
+    fill_fraction : fraction of granules that are all fill
+    cloud_fraction : fraction of Fmask pixels with the cloud bit set
+    seed : seed of the random values
+
+    Returns
+    -------
+    n : number of granules written
+
+    """
+    rng = np.random.default_rng(seed)
+    blocks = return_site_blocks()
+    n = 0
+    for satellite,years in (('L30',years_L30),('S30',years_S30)):
+        for year in years:
+            image_path = root+satellite+'/'+str(year)+tile_dir
+            for k in range(granules):
+                doy = 1+k*365//granules
+                name = return_granule_name(satellite, year, doy)
+                os.makedirs(image_path+'/'+name, exist_ok=True)
+                fill = rng.random() < fill_fraction
+                for band,suffix in bands_by_satellite[satellite].items():
+                    write_band(image_path+'/'+name+'/'+name+'.'+suffix+'.tif', blocks, fill,
+                               band == 'Quality', cloud_fraction, rng)
+                n += 1
+    return n
+
+"""
+Write the archive given on the command line
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic HLS archive for import_HLS_pixel_data.py")
+    parser.add_argument("root",type=str,nargs='?',default='path_to_hls_imagery',
+                        help="prefix of the L30/S30 folders, as image_path_1 in import_HLS_pixel_data.py "
+                             "(default path_to_hls_imagery)")
+    parser.add_argument("--granules",type=int,default=10,
+                        help="granules per satellite and year (default 10)")
+    parser.add_argument("--years-L30",type=int,nargs='+',default=[2021])
+    parser.add_argument("--years-S30",type=int,nargs='+',default=[2021])
+    parser.add_argument("--fill-fraction",type=float,default=0.1,
+                        help="fraction of granules that are all fill (default 0.1)")
+    parser.add_argument("--cloud-fraction",type=float,default=0.2,
+                        help="fraction of Fmask pixels with the cloud bit set (default 0.2)")
+    parser.add_argument("--seed",type=int,default=0)
+    args = parser.parse_args()
+    n = make_archive(args.root, args.granules, args.years_L30, args.years_S30,
+                     args.fill_fraction, args.cloud_fraction, args.seed)
+    print(str(n)+" granules written under "+args.root+"L30 and "+args.root+"S30")
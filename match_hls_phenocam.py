@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Pairs each HLS scene with the PhenoCam 3-day GCC closest in time
+
+Builds one table of matched HLS/PhenoCam pairs for every phenocam at once:
+    1. reads the <phenocam>_center.csv (or .parquet) files written by
+       import_HLS_pixel_data.py, with GCC computed from the Blue, Green and
+       Red means (return_analysis_frame), and flags the clean scenes as
+       import_hls_data.R does
+    2. reads the <phenocam>_<veg>_1000_3day.csv files saved by
+       download_phenocam_data.R, keeping the dates with a gcc_90 value
+    3. gives every row an int64 key of (phenocam, day), so the camera rows of
+       all phenocams form one sorted array, and finds the camera date nearest
+       to (or on/before, or on/after) every scene with two searchsorted calls.
+       Scenes without a camera date within the tolerance are left out; keys
+       of different phenocams are 2^32 days apart, so they never match.
+
+Each output row holds the scene's date, sensor, GCC, NDVI, EVI and CLEAN flag,
+the matched camera date, the days from the scene to it (DAYS_APART) and the
+camera columns (gcc_90 and smooth_gcc_90 by default).
+
+Example:
+    python match_hls_phenocam.py --tolerance 1 --clean
+"""
+
+# Imports
+import argparse
+import glob
+import os
+import numpy as np
+import pandas as pd
+from process_hls_v20_data import eco_states, read_hls_data, return_clean
+
+# Region of interest of the 3-day files R reads, the columns kept from them
+# (the first one must be present for a camera date to be matched), and the
+# key offset between phenocams
+phenocam_roi = '1000'
+phenocam_columns = ('gcc_90', 'smooth_gcc_90')
+site_key_step = 2**32
+
+hls_columns = ('DATE', 'YEAR', 'DOY', 'PHENOCAM_NAME', 'ECO_STATE', 'SATELLITE', 'CLEAN', 'GCC', 'NDVI', 'EVI')
+
+# Functions
+def read_phenocam_3day(phenocam_dir,phenocam,columns=phenocam_columns,roi=phenocam_roi):
+    """
+    Parameters
+    ----------
+    phenocam_dir : directory holding the PhenoCam 3-day summary files
+    phenocam : phenocam name
+    columns : columns of the 3-day file to keep; rows where the first one is
+        missing are dropped
+    roi : region of interest number in the file name
+
+    Returns
+    -------
+    df : data frame of PHENOCAM_NAME, date (datetime64[D]) and the columns
+        (float64), sorted by date, or None if the phenocam has no 3-day file
+
+    """
+    filenames = glob.glob(os.path.join(phenocam_dir, glob.escape(phenocam)+'_*_'+roi+'_3day.csv'))
+    if not filenames:
+        return None
+    if len(filenames) > 1:
+        raise Exception("More than one 3-day file for "+phenocam+": "+', '.join(sorted(filenames)))
+    # The metadata header is made of '#' lines; comment='#' would also cut
+    # data lines at any '#' in a file name column
+    skip = 0
+    with open(filenames[0]) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            skip += 1
+    df = pd.read_csv(filenames[0], skiprows=skip, usecols=['date']+list(columns))
+    df = df[df[columns[0]].notna()]
+    date = pd.to_datetime(df['date']).to_numpy().astype('datetime64[D]')
+    order = np.argsort(date, kind='stable')
+    data = {'PHENOCAM_NAME':np.full(len(df), phenocam, dtype=object),
+            'date':date[order]}
+    for column in columns:
+        data[column] = df[column].to_numpy(dtype=np.float64)[order]
+    return pd.DataFrame(data)
+
+def return_keys(site_codes,days):
+    """
+    Returns int64 keys ordering rows by site code, then day (days since 1970)
+    """
+    return site_codes.astype(np.int64)*site_key_step+days.astype(np.int64)
+
+def match_nearest(keys,sorted_keys,tolerance,direction='nearest'):
+    """
+    Parameters
+    ----------
+    keys : int64 array of (site, day) keys to match
+    sorted_keys : sorted int64 array of the keys to match against
+    tolerance : largest number of days between matched keys
+    direction : 'nearest', 'backward' (keys on or before) or 'forward' (on or after)
+
+    Returns
+    -------
+    index : int64 array, position in sorted_keys of the match of each key, -1
+        where there is none within the tolerance. With 'nearest', a key halfway
+        between two others is matched to the earlier one.
+
+    """
+    n = len(sorted_keys)
+    if n == 0:
+        return np.full(len(keys), -1, dtype=np.int64)
+    no_match = np.iinfo(np.int64).max
+    before = np.searchsorted(sorted_keys, keys, side='right')-1
+    after = np.searchsorted(sorted_keys, keys, side='left')
+    gap_before = np.where(before >= 0, keys-sorted_keys[np.maximum(before,0)], no_match)
+    gap_after = np.where(after < n, sorted_keys[np.minimum(after,n-1)]-keys, no_match)
+    if direction == 'backward':
+        index,gap = before,gap_before
+    elif direction == 'forward':
+        index,gap = after,gap_after
+    else:
+        earlier = gap_before <= gap_after
+        index = np.where(earlier, before, after)
+        gap = np.where(earlier, gap_before, gap_after)
+    return np.where(gap <= tolerance, index, -1).astype(np.int64)
+
+def match_hls_phenocam(hls_data,phenocam_data,tolerance=1,direction='nearest',columns=phenocam_columns):
+    """
+    Parameters
+    ----------
+    hls_data : data frame of HLS scenes (see read_hls_data) with a CLEAN column
+    phenocam_data : data frame of camera dates of one or more phenocams (see
+        read_phenocam_3day)
+    tolerance : largest number of days between a scene and its camera date
+    direction : see match_nearest
+    columns : camera columns to copy next to the scenes
+
+    Returns
+    -------
+    pairs : data frame with the hls_columns of each matched scene, then
+        PHENOCAM_DATE, DAYS_APART (camera date minus scene date) and the camera
+        columns, sorted by phenocam (in the order of hls_data), date and the
+        order of the scenes in hls_data
+
+    """
+    sites = pd.unique(np.concatenate([hls_data['PHENOCAM_NAME'].to_numpy(dtype=object),
+                                      phenocam_data['PHENOCAM_NAME'].to_numpy(dtype=object)]))
+    hls_year = hls_data['YEAR'].to_numpy(dtype=np.int64)
+    hls_days = ((hls_year-1970).astype('datetime64[Y]').astype('datetime64[D]')
+                +(hls_data['DOY'].to_numpy(dtype=np.int64)-1)).astype(np.int64)
+    hls_keys = return_keys(pd.Categorical(hls_data['PHENOCAM_NAME'], categories=sites).codes, hls_days)
+    camera_days = phenocam_data['date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+    camera_keys = return_keys(pd.Categorical(phenocam_data['PHENOCAM_NAME'], categories=sites).codes, camera_days)
+    camera_order = np.argsort(camera_keys, kind='stable')
+
+    index = match_nearest(hls_keys, camera_keys[camera_order], tolerance, direction)
+    matched = np.flatnonzero(index >= 0)
+    matched = matched[np.argsort(hls_keys[matched], kind='stable')]
+    camera_rows = camera_order[index[matched]]
+
+    pairs = hls_data.iloc[matched][list(hls_columns)].reset_index(drop=True)
+    pairs['PHENOCAM_DATE'] = pd.Series(camera_days[camera_rows].astype('datetime64[D]')).dt.date
+    pairs['DAYS_APART'] = camera_days[camera_rows]-hls_days[matched]
+    for column in columns:
+        pairs[column] = phenocam_data[column].to_numpy()[camera_rows]
+    return pairs
+
+"""
+Match the phenocams given on the command line
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pair HLS scenes with the nearest PhenoCam 3-day GCC")
+    parser.add_argument("phenocams",type=str,nargs='*',default=None,
+                        help="phenocams to match (default: every phenocam in eco_states)")
+    parser.add_argument("--input-dir",type=str,default='data/outputs_HLS/',
+                        help="directory of the import_HLS_pixel_data.py outputs (default data/outputs_HLS/)")
+    parser.add_argument("--parquet",action='store_true',
+                        help="read <phenocam>_<region>.parquet instead of the CSV files (needs pyarrow)")
+    parser.add_argument("--region",type=str,default='center',choices=('center','north'),
+                        help="HLS pixels to use (default center)")
+    parser.add_argument("--phenocam-dir",type=str,default='data/phenocam/',
+                        help="directory of the PhenoCam 3-day files (default data/phenocam/)")
+    parser.add_argument("--phenocam-columns",type=str,nargs='+',default=list(phenocam_columns),
+                        help="3-day file columns to copy; camera dates need a value in the first "
+                             "(default "+' '.join(phenocam_columns)+")")
+    parser.add_argument("--tolerance",type=int,default=1,
+                        help="largest number of days between a scene and its camera date (default 1)")
+    parser.add_argument("--direction",type=str,default='nearest',choices=('nearest','backward','forward'),
+                        help="match the nearest camera date, or the nearest on or before (backward) "
+                             "or on or after (forward) the scene (default nearest)")
+    parser.add_argument("--clean",action='store_true',
+                        help="only match the clean scenes (as in hls_center_clean)")
+    parser.add_argument("--output",type=str,default='outputs/hls_phenocam_pairs.csv',
+                        help="output file, written as Parquet if it ends in .parquet "
+                             "(default outputs/hls_phenocam_pairs.csv)")
+    args = parser.parse_args()
+    if args.tolerance < 0:
+        parser.error("--tolerance must be at least 0")
+
+    phenocams = args.phenocams or list(eco_states)
+    frames = []
+    for phenocam in phenocams:
+        df = read_phenocam_3day(args.phenocam_dir, phenocam, args.phenocam_columns)
+        if df is None:
+            print(phenocam+": no "+phenocam_roi+" 3-day file in "+args.phenocam_dir+", skipped")
+            continue
+        frames.append(df)
+    if not frames:
+        parser.error("no 3-day file for any of the phenocams in "+args.phenocam_dir)
+    phenocam_data = pd.concat(frames, ignore_index=True)
+    hls_data = read_hls_data(args.input_dir, phenocams, args.region, args.parquet)
+    hls_data['CLEAN'] = return_clean(hls_data)
+    if args.clean:
+        hls_data = hls_data[hls_data['CLEAN']]
+    pairs = match_hls_phenocam(hls_data, phenocam_data, args.tolerance, args.direction, args.phenocam_columns)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    if args.output.endswith('.parquet'):
+        pairs.to_parquet(args.output+'.tmp', engine='pyarrow', index=False)
+    else:
+        pairs.to_csv(args.output+'.tmp', index=False)
+    os.replace(args.output+'.tmp', args.output)
+    print(str(len(pairs))+" pairs from "+str(len(hls_data))+" scenes and "+str(len(phenocam_data))
+          +" camera dates, "+str(pairs['PHENOCAM_NAME'].nunique())+" phenocams -> "+args.output)
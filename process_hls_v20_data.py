@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Smooths the HLS EVI time series and finds the season start and end dates
+
+Python version of the smoothing, scaling and season steps of
+process_hls_v20_data.R, computed for all phenocams and years at once:
+    1. reads the <phenocam>_center.csv (or .parquet) files written by
+       import_HLS_pixel_data.py and keeps the clean scenes from 2016 on, as
+       import_hls_data.R does
+    2. fits a LOESS of EVI against date for each phenocam (span 0.03, degree 2,
+       tricube weights, exact local fits as with surface="direct") and
+       predicts it for every day. The local fits of all days are solved
+       together as one stack of small weighted least squares problems, and
+       phenocams are split across worker processes.
+    3. scales the smoothed EVI to 0-1 within each phenocam and year
+    4. finds the peak, the pre- and post-peak minima and the day EVI first
+       rises above (SOS) and last falls below (EOS) 10, 15, 25 and 50% of the
+       yearly range, for every phenocam-year in one pass over a
+       (phenocam-years x 366 days) array
+
+The outputs are CSV versions of the R objects hls_smooth_scaled and
+season_start_and_end_hls, with the same columns. --validate compares them
+with an RData file saved by process_hls_v20_data.R (needs pyreadr).
+
+Example:
+    python process_hls_v20_data.py --workers 4 --validate outputs/hls_v20_processed.RData
+"""
+
+# Imports
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+import pandas as pd
+from import_HLS_pixel_data import return_analysis_frame
+
+# Phenocams in the order import_hls_data.R reads them, and their ecological state
+eco_states = {'jershrubland':'Sandy shrubland',
+              'jershrubland2':'Sandy shrubland',
+              'jernovel':'Sandy shrub-invaded grassland',
+              'jernovel2':'Sandy shrub-invaded grassland',
+              'jergrassland':'Sandy shrub-invaded grassland',
+              'jergrassland2':'Sandy shrub-invaded grassland',
+              'jerbajada':'Gravelly shrubland',
+              'jernort':'Sandy shrubland',
+              'ibp':'Sandy shrub-invaded grassland',
+              'jernwern':'Sandy shrubland',
+              'NEON.D14.JORN.DP1.00033':'Sandy shrub-invaded grassland',
+              'jersand':'Gravelly shrubland'}
+
+# Years kept (2013-2015 have too few S30 scenes), LOESS span and season thresholds
+first_year = 2016
+last_year = 2022
+loess_span = 0.03
+season_thresholds = (0.10, 0.15, 0.25, 0.50)
+
+season_columns = ('phenocam_name', 'eco_state', 'year', 'peak_EVI',
+                  'DOY_peak', 'DOY_min_pre_peak', 'DOY_min_post_peak',
+                  'SOS_10', 'SOS_15', 'SOS_25', 'SOS_50', 'EOS_10', 'EOS_15', 'EOS_25', 'EOS_50')
+
+# Functions
+def return_eco_state(phenocam_name):
+    """
+    Returns the ecological site and state of a phenocam, 'unknown' if it is not in eco_states
+    """
+    return eco_states.get(phenocam_name, 'unknown')
+
+def read_hls_data(input_dir,phenocams,region='center',parquet=False):
+    """
+    Parameters
+    ----------
+    input_dir : directory holding the outputs of import_HLS_pixel_data.py
+    phenocams : list of phenocam names
+    region : 'center' or 'north', which outputs to read
+    parquet : whether to read <phenocam>_<region>.parquet instead of the CSV file
+
+    Returns
+    -------
+    hls_data : data frame of every scene with the columns of hls_data_center
+        in import_hls_data.R (date, phenocam, eco state, sensor, GCC, NDVI,
+        EVI, band standard deviations and QA bits), phenocams in the order given
+
+    """
+    frames = []
+    for phenocam in phenocams:
+        if parquet:
+            df = pd.read_parquet(os.path.join(input_dir, phenocam+'_'+region+'.parquet'))
+        else:
+            df = return_analysis_frame(pd.read_csv(os.path.join(input_dir, phenocam+'_'+region+'.csv'),
+                                                   index_col=0, float_precision='round_trip'))
+        df.insert(4, 'ECO_STATE', df['PHENOCAM_NAME'].map(return_eco_state))
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+def return_clean(hls_data):
+    """
+    Returns a boolean array, True for the scenes without high aerosol, cloud,
+    cloud shadow or cloud adjacency (the scenes import_hls_data.R keeps)
+    """
+    return (~(hls_data['Aerosol1'] & hls_data['Aerosol2']) & ~hls_data['Cloud'] &
+            ~hls_data['CloudShadow'] & ~hls_data['CloudAdjacent']).to_numpy(dtype=bool)
+
+def read_hls_clean(input_dir,phenocams,parquet=False):
+    """
+    Parameters
+    ----------
+    input_dir : directory holding the outputs of import_HLS_pixel_data.py
+    phenocams : list of phenocam names
+    parquet : whether to read <phenocam>_center.parquet instead of _center.csv
+
+    Returns
+    -------
+    hls_center_clean : data frame of the clean scenes (see return_clean), with
+        the columns of hls_center_clean in import_hls_data.R, sorted by date
+        (then phenocam, in the order given)
+
+    """
+    hls_data = read_hls_data(input_dir, phenocams, 'center', parquet)
+    hls_data = hls_data[return_clean(hls_data)]
+    return hls_data.sort_values('DATE', kind='mergesort', ignore_index=True)
+
+def return_neighbor_windows(x,t,q):
+    """
+    Parameters
+    ----------
+    x : sorted array of n predictor values
+    t : array of evaluation points
+    q : number of nearest neighbors (1 to n)
+
+    Returns
+    -------
+    start : array of the index in x of the first of the q values nearest each
+        point; the q nearest values of t[i] are x[start[i]:start[i]+q]
+
+    """
+    # Moving a window right by one swaps x[i] for x[i+q], which helps while
+    # x[i+q]-t < t-x[i]; x[i]+x[i+q] is sorted, so the best start is a binary search
+    return np.searchsorted(x[:len(x)-q]+x[q:], 2*t, side='left')
+
+def loess_direct(x,y,t,span=loess_span,degree=2):
+    """
+    Parameters
+    ----------
+    x : array of predictor values (e.g. dates as days since 1970-01-01)
+    y : array of responses
+    t : array of points to predict at
+    span : fraction of the points in each local fit
+    degree : degree of the local polynomials
+
+    Returns
+    -------
+    fit : array of the LOESS predictions at t, as R's
+        predict(loess(y ~ x, span=span, degree=degree, control=loess.control(surface="direct")), t)
+        (gaussian family, no robustness iterations). Each point is fitted from
+        its q = floor(n*span) nearest values with tricube weights on the
+        distance over the q-th nearest distance; all local fits are solved at
+        once with a stacked pseudo-inverse.
+
+    """
+    order = np.argsort(x, kind='stable')
+    x = np.asarray(x, dtype=np.float64)[order]
+    y = np.asarray(y, dtype=np.float64)[order]
+    t = np.asarray(t, dtype=np.float64)
+    q = min(len(x), int(np.floor(len(x)*span)))
+    if q < 1:
+        raise Exception("LOESS span too small for "+str(len(x))+" points")
+    idx = return_neighbor_windows(x, t, q)[:,np.newaxis]+np.arange(q)
+    d = x[idx]-t[:,np.newaxis]
+    h = np.abs(d).max(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        u = np.where(h > 0, d/h, 0)
+    w = np.sqrt((1-np.minimum(np.abs(u),1)**3)**3)
+    # Local polynomial in (x-t)/h, so the fitted value at t is the constant term
+    design = w[...,np.newaxis]*u[...,np.newaxis]**np.arange(degree+1)
+    return np.einsum('mk,mk->m', np.linalg.pinv(design)[:,0,:], w*y[idx])
+
+def smooth_phenocam(task):
+    """
+    Parameters
+    ----------
+    task : (dates, evi, days, span) of one phenocam: dates and EVI of its
+        scenes, the days to predict at (all as days since 1970-01-01) and the LOESS span
+
+    Returns
+    -------
+    evi_smooth : array of the smoothed EVI on each of days
+
+    """
+    dates,evi,days,span = task
+    return loess_direct(dates, evi, days, span)
+
+def smooth_evi(hls_data,span=loess_span,workers=1):
+    """
+    Parameters
+    ----------
+    hls_data : data frame of clean scenes (see read_hls_clean)
+    span : LOESS span
+    workers : number of processes fitting phenocams in parallel
+
+    Returns
+    -------
+    hls_smooth : data frame of DATE, YEAR, DOY, PHENOCAM_NAME, ECO_STATE,
+        LOESS_SPAN and EVI_smooth, one row for every day from each phenocam's
+        first to last scene
+
+    """
+    dates = pd.to_datetime(hls_data['DATE']).to_numpy().astype('datetime64[D]').astype(np.int64)
+    evi = hls_data['EVI'].to_numpy(dtype=np.float64)
+    phenocams = list(pd.unique(hls_data['PHENOCAM_NAME']))
+    tasks = []
+    for phenocam in phenocams:
+        rows = (hls_data['PHENOCAM_NAME'] == phenocam).to_numpy()
+        fit = rows & np.isfinite(evi)
+        days = np.arange(dates[rows].min(), dates[rows].max()+1)
+        tasks.append((dates[fit], evi[fit], days, span))
+    if workers == 1:
+        fits = list(map(smooth_phenocam, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            fits = list(pool.map(smooth_phenocam, tasks))
+    frames = []
+    for phenocam,task,evi_smooth in zip(phenocams,tasks,fits):
+        days = task[2]
+        date = days.astype('datetime64[D]')
+        year = date.astype('datetime64[Y]').astype(np.int64)+1970
+        doy = (date-date.astype('datetime64[Y]').astype('datetime64[D]')).astype(np.int64)+1
+        frames.append(pd.DataFrame({'DATE':pd.Series(date).dt.date,
+                                    'YEAR':year,
+                                    'DOY':doy,
+                                    'PHENOCAM_NAME':phenocam,
+                                    'ECO_STATE':return_eco_state(phenocam),
+                                    'LOESS_SPAN':span,
+                                    'EVI_smooth':evi_smooth}))
+    return pd.concat(frames, ignore_index=True)
+
+def scale_yearly(hls_smooth):
+    """
+    Returns hls_smooth with an EVI_scaled_yearly column: the smoothed EVI
+    scaled to 0-1 by its minimum and maximum within each phenocam and year
+    """
+    groups = hls_smooth.groupby(['PHENOCAM_NAME','YEAR'], sort=False)['EVI_smooth']
+    evi_min = groups.transform('min').to_numpy(); evi_max = groups.transform('max').to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scaled = (hls_smooth['EVI_smooth'].to_numpy()-evi_min)/(evi_max-evi_min)
+    return hls_smooth.assign(EVI_scaled_yearly=scaled)
+
+def return_season_metrics(hls_smooth_scaled,thresholds=season_thresholds):
+    """
+    Parameters
+    ----------
+    hls_smooth_scaled : data frame from scale_yearly
+    thresholds : fractions of the yearly range for SOS/EOS
+
+    Returns
+    -------
+    season_start_and_end_hls : data frame with one row per phenocam-year
+        (first_year to last_year) and the columns of season_start_and_end_hls
+        in process_hls_v20_data.R: peak EVI and its DOY (first day the scaled
+        EVI is 1), the DOY of the pre-peak (first) and post-peak (last) minima,
+        and for each threshold the first DOY from the pre-peak minimum on
+        (SOS) and the last DOY up to the post-peak minimum (EOS) where the
+        scaled EVI is above it. As in R, days with no match are Inf (or -Inf
+        for maxima). Years without a peak (constant EVI) are left out.
+
+    """
+    keys = hls_smooth_scaled[['PHENOCAM_NAME','YEAR']]
+    group = keys.groupby(['PHENOCAM_NAME','YEAR'], sort=False).ngroup().to_numpy()
+    first = keys[~keys.duplicated()]
+    n_groups = len(first)
+    # Scaled and smoothed EVI of each phenocam-year by DOY (column DOY-1), NaN where missing
+    doy = hls_smooth_scaled['DOY'].to_numpy(dtype=np.int64)
+    scaled = np.full((n_groups,366), np.nan)
+    smooth = np.full((n_groups,366), np.nan)
+    scaled[group,doy-1] = hls_smooth_scaled['EVI_scaled_yearly'].to_numpy(dtype=np.float64)
+    smooth[group,doy-1] = hls_smooth_scaled['EVI_smooth'].to_numpy(dtype=np.float64)
+    days = np.arange(1,367, dtype=np.float64)
+    rows = np.arange(n_groups)
+
+    def first_day(condition):
+        """First DOY where condition holds in each row, Inf if none"""
+        return np.where(condition.any(axis=1), days[np.argmax(condition, axis=1)], np.inf)
+
+    def last_day(condition):
+        """Last DOY where condition holds in each row, -Inf if none"""
+        return np.where(condition.any(axis=1), days[365-np.argmax(condition[:,::-1], axis=1)], -np.inf)
+
+    is_peak = scaled == 1
+    has_peak = is_peak.any(axis=1)
+    peak = first_day(is_peak)
+    peak_index = np.argmax(is_peak, axis=1)[:,np.newaxis]
+    finite = np.where(np.isnan(scaled), np.inf, scaled)
+    min_pre = np.where(np.arange(366) < peak_index, finite, np.inf).min(axis=1)
+    min_post = np.where(np.arange(366) > peak_index, finite, np.inf).min(axis=1)
+    doy_min_pre = first_day(scaled == min_pre[:,np.newaxis])
+    doy_min_post = last_day(scaled == min_post[:,np.newaxis])
+    season = {'phenocam_name':first['PHENOCAM_NAME'].to_numpy(dtype=object),
+              'eco_state':first['PHENOCAM_NAME'].map(return_eco_state).to_numpy(dtype=object),
+              'year':first['YEAR'].to_numpy(dtype=np.int64),
+              'peak_EVI':smooth[rows,np.argmax(is_peak, axis=1)],
+              'DOY_peak':peak,
+              'DOY_min_pre_peak':doy_min_pre,
+              'DOY_min_post_peak':doy_min_post}
+    for threshold in thresholds:
+        above = scaled > threshold
+        season['SOS_'+str(int(round(threshold*100)))] = first_day(above & (days >= doy_min_pre[:,np.newaxis]))
+    for threshold in thresholds:
+        above = scaled > threshold
+        season['EOS_'+str(int(round(threshold*100)))] = last_day(above & (days <= doy_min_post[:,np.newaxis]))
+    season = pd.DataFrame(season)
+    keep = has_peak & (season['year'] >= first_year).to_numpy() & (season['year'] <= last_year).to_numpy()
+    return season[keep].reset_index(drop=True)
+
+def compare_rdata(rdata_file,hls_smooth_scaled,season):
+    """
+    Parameters
+    ----------
+    rdata_file : RData file saved by process_hls_v20_data.R (read with pyreadr)
+    hls_smooth_scaled, season : outputs of scale_yearly and return_season_metrics
+
+    Returns
+    -------
+    report : list of lines comparing the outputs with hls_smooth_scaled and
+        season_start_and_end_hls in the RData file
+
+    """
+    import pyreadr
+    r_objects = pyreadr.read_r(rdata_file, use_objects=['hls_smooth_scaled','season_start_and_end_hls'])
+    report = []
+    keys = ['PHENOCAM_NAME','YEAR','DOY']
+    r_smooth = r_objects['hls_smooth_scaled'].astype({'PHENOCAM_NAME':object,'YEAR':np.int64,'DOY':np.int64})
+    merged = hls_smooth_scaled.merge(r_smooth, on=keys, how='outer', suffixes=('','_R'), indicator=True)
+    both = merged['_merge'] == 'both'
+    report.append("hls_smooth_scaled: "+str(len(hls_smooth_scaled))+" rows, "+str(len(r_smooth))+" in R, "+
+                  str(int(both.sum()))+" matched")
+    for column in ('EVI_smooth','EVI_scaled_yearly'):
+        difference = np.abs(merged[column][both]-merged[column+'_R'][both])
+        report.append("  "+column+": max abs difference "+format(difference.max(),'.3g'))
+    keys = ['phenocam_name','year']
+    r_season = r_objects['season_start_and_end_hls'].astype({'phenocam_name':object,'year':np.int64})
+    merged = season.merge(r_season, on=keys, how='outer', suffixes=('','_R'), indicator=True)
+    both = merged['_merge'] == 'both'
+    report.append("season_start_and_end_hls: "+str(len(season))+" phenocam-years, "+str(len(r_season))+" in R, "+
+                  str(int(both.sum()))+" matched")
+    report.append("  peak_EVI: max abs difference "+
+                  format(np.abs(merged['peak_EVI'][both]-merged['peak_EVI_R'][both]).max(),'.3g'))
+    for column in season_columns[4:]:
+        same = (merged[column][both] == merged[column+'_R'][both]).sum()
+        report.append("  "+column+": "+str(int(same))+" of "+str(int(both.sum()))+" equal")
+    return report
+
+"""
+Smooth, scale and find the season dates of the phenocams given on the command line
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Smooth HLS EVI and find season start/end dates "
+                                                 "(the LOESS and season steps of process_hls_v20_data.R)")
+    parser.add_argument("phenocams",type=str,nargs='*',default=None,
+                        help="phenocams to process (default: every phenocam in eco_states)")
+    parser.add_argument("--input-dir",type=str,default='data/outputs_HLS/',
+                        help="directory of the import_HLS_pixel_data.py outputs (default data/outputs_HLS/)")
+    parser.add_argument("--parquet",action='store_true',
+                        help="read <phenocam>_center.parquet instead of _center.csv (needs pyarrow)")
+    parser.add_argument("--output-dir",type=str,default='outputs/',
+                        help="directory for hls_smooth_scaled.csv and season_start_and_end_hls.csv (default outputs/)")
+    parser.add_argument("--span",type=float,default=loess_span,
+                        help="LOESS span (default "+str(loess_span)+")")
+    parser.add_argument("--workers",type=int,default=1,
+                        help="number of processes fitting phenocams in parallel (default 1)")
+    parser.add_argument("--validate",type=str,default=None,
+                        help="compare the outputs with an RData file from process_hls_v20_data.R, "
+                             "e.g. outputs/hls_v20_processed.RData (needs pyreadr)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if not 0 < args.span <= 1:
+        parser.error("--span must be above 0 and at most 1")
+    if args.validate:
+        try:
+            import pyreadr
+        except ImportError:
+            parser.error("--validate needs the pyreadr package (pip install pyreadr)")
+
+    hls_data = read_hls_clean(args.input_dir, args.phenocams or list(eco_states), args.parquet)
+    hls_data = hls_data[hls_data['YEAR'] >= first_year]
+    hls_smooth_scaled = scale_yearly(smooth_evi(hls_data, args.span, args.workers))
+    season = return_season_metrics(hls_smooth_scaled)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for df,filename in ((hls_smooth_scaled,'hls_smooth_scaled.csv'),(season,'season_start_and_end_hls.csv')):
+        df.to_csv(os.path.join(args.output_dir, filename+'.tmp'), index=False)
+        os.replace(os.path.join(args.output_dir, filename+'.tmp'), os.path.join(args.output_dir, filename))
+    print(str(hls_smooth_scaled['PHENOCAM_NAME'].nunique())+" phenocams, "+str(len(season))+" phenocam-years")
+    if args.validate:
+        for line in compare_rdata(args.validate, hls_smooth_scaled, season):
+            print(line)